@@ -0,0 +1,345 @@
+"""
+Benchmarks both converters on a deterministic corpus of synthetic 1-bit frames (solid shapes, text, noise and dither worst
+cases, Bad Apple like silhouettes and a small figure moving over a still backdrop) at a few resolutions, timing each stage
+separately. Each converter can also be run on each case's frames as one batch of consecutive frames like its workers do,
+where only what changed from one frame to the next is redone. Results are written as JSON and,
+if a baseline from an earlier run is given, compared against it so it's clear whether a change helped or hurt.
+
+The potrace backend needs the potrace program. Every SVG it gives is recorded in FIXTURE_FOLDER so that machines without
+potrace can still benchmark the rest of the vector pipeline by replaying them (tracing time is then just reading the file).
+"""
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+import os, io, sys, json, time, tempfile, contextlib, platform, logging
+import multiprocessing
+from osc_output import SampleFile
+from osc_cache import frame_key
+from osc_trace import potrace_svg, parse_svg_paths, ContourTracer, SVG_UNITS_PER_PIXEL
+import vid_to_osc_raster as raster
+import vid_to_osc_vector as vector
+
+#Not available on Windows, where peak memory just isn't reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#Accumulates the time spent in each stage by wrapping the function that does it
+def timed(stage_seconds, stage, function):
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_seconds[stage] = stage_seconds.get(stage, 0) + time.perf_counter() - start_time
+    return wrapper
+
+#Peak resident memory of this process so far in MB, or None where we can't tell. Only ever goes up, so each case is run in its
+#own process to get a peak that's just for that case
+def peak_rss_mb():
+    if(resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10   #Bytes on macOS, KB everywhere else
+
+
+#Synthetic frames, all (height, width) boolean arrays where True = white. Each kind is seeded so every run sees the same frames
+
+#Circles and rectangles drifting across a white background
+def shapes_frames(width, height, count, rng):
+    shape_count = 12
+    centers = rng.uniform(0, 1, (shape_count, 2))*[width, height]
+    velocities = rng.uniform(-0.02, 0.02, (shape_count, 2))*[width, height]
+    sizes = rng.uniform(0.03, 0.15, shape_count)*min(width, height)
+    is_circle = rng.random(shape_count) < 0.5
+    ys, xs = np.mgrid[0:height, 0:width]
+    for i in range(count):
+        frame = np.ones((height, width), dtype=bool)
+        for (x, y), size, circle in zip((centers + velocities*i) % [width, height], sizes, is_circle):
+            if(circle):
+                frame &= (xs - x)**2 + (ys - y)**2 > size**2
+            else:
+                frame &= (np.abs(xs - x) > size) | (np.abs(ys - y) > size*0.6)
+        yield frame
+
+#Lines of black text scrolling up a white page
+def text_frames(width, height, count, rng):
+    words = ["oscilloscope", "lissajous", "vector", "raster", "beam", "phosphor", "sample", "frame", "potrace", "contour"]
+    lines = [" ".join(rng.choice(words, 6)) for _ in range(40)]
+    font = ImageFont.load_default()
+    scale = max(1, height//120)  #Bitmap font so draw small and scale up with nearest neighbour to keep it 1-bit
+    page = Image.new("1", (width//scale, 12*len(lines)), 1)
+    draw = ImageDraw.Draw(page)
+    for i, line in enumerate(lines):
+        draw.text((2, 12*i), line, fill=0, font=font)
+
+    page = np.asarray(page, dtype=bool)
+    for i in range(count):
+        rows = np.arange(height//scale) + i*3
+        frame = page[rows % len(page)]
+        yield np.repeat(np.repeat(frame, scale, axis=0), scale, axis=1)[:height, :width] if scale > 1 else frame[:, :width]
+
+#Independent random pixels, the worst case for both converters (lots of tiny runs/outlines)
+def noise_frames(width, height, count, rng):
+    for _ in range(count):
+        yield rng.random((height, width)) < 0.5
+
+#A moving gradient with 4x4 Bayer ordered dithering, a regular but still very busy worst case
+def dither_frames(width, height, count, rng):
+    bayer = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]])/16 + 1/32
+    thresholds = np.tile(bayer, (height//4 + 1, width//4 + 1))[:height, :width]
+    ys, xs = np.mgrid[0:height, 0:width]
+    angle = rng.uniform(0, np.pi)
+    for i in range(count):
+        gradient = (np.cos(angle)*xs/width + np.sin(angle)*ys/height + i*0.05) % 1
+        yield gradient > thresholds
+
+#Smooth blobs that grow, merge and split over time like Bad Apple's silhouettes, from a few low frequency waves
+def silhouette_frames(width, height, count, rng):
+    wave_count = 6
+    frequencies = rng.uniform(1, 4, (wave_count, 2))*2*np.pi
+    phases = rng.uniform(0, 2*np.pi, wave_count)
+    speeds = rng.uniform(0.1, 0.3, wave_count)
+    ys, xs = np.mgrid[0:height, 0:width]
+    xs, ys = xs/width, ys/height
+    for i in range(count):
+        field = sum(np.sin(fx*xs + fy*ys + phase + speed*i) for (fx, fy), phase, speed in zip(frequencies, phases, speeds))
+        yield field > 0.5
+
+#One small figure walking across a still backdrop of shapes, where only redoing the parts that changed pays off
+def walker_frames(width, height, count, rng):
+    backdrop = next(shapes_frames(width, height, 1, rng))
+    ys, xs = np.mgrid[0:height, 0:width]
+    radius = 0.06*min(width, height)
+    y = rng.uniform(0.3, 0.7)*height
+    for i in range(count):
+        x = (0.1 + 0.03*i) % 1*width
+        yield backdrop ^ ((xs - x)**2 + (ys - y)**2 < radius**2)
+
+FRAME_KINDS = {"shapes": shapes_frames, "text": text_frames, "noise": noise_frames, "dither": dither_frames, "silhouette": silhouette_frames, "walker": walker_frames}
+
+def synthetic_frames(kind, width, height, count):
+    seed = sorted(FRAME_KINDS).index(kind)
+    return list(FRAME_KINDS[kind](width, height, count, np.random.default_rng(seed)))
+
+
+#Time writing a case's samples to a .wav, which is the same for both converters
+def time_wav_write(frame_samples, x_extent, y_extent, stage_seconds):
+    with tempfile.TemporaryDirectory() as folder:
+        with SampleFile(os.path.join(folder, "bench.wav"), SAMPLE_RATE, x_extent, y_extent) as output:
+            write = timed(stage_seconds, "wav_write", output.write)
+            for frame_points in frame_samples:
+                write(frame_points)
+
+#With incremental the frames go through convert_frame_chunk together like a worker's batch, so each one after the first only
+#has the columns that changed since the one before re-extracted (update_runs)
+def bench_raster(frames, incremental=False):
+    stage_seconds = {}
+    raster.SAMPLE_POINTS = SAMPLE_POINTS
+    for name, function in raster_originals.items():
+        setattr(raster, name, timed(stage_seconds, name, function))
+
+    #update_runs extracts the runs of just the columns that changed, count that as part of updating rather than extracting
+    timed_update_runs = raster.update_runs
+    def update_runs(*args):
+        extract_seconds = stage_seconds.get("extract_runs", 0)
+        try:
+            return timed_update_runs(*args)
+        finally:
+            stage_seconds["extract_runs"] = extract_seconds
+    raster.update_runs = update_runs
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):    #Don't flood the report with pruning warnings
+            if(incremental):
+                packed_chunk = [(frame.shape, np.packbits(frame).tobytes()) for frame in frames]
+                frame_samples = np.frombuffer(raster.convert_frame_chunk(packed_chunk), dtype=np.int16).reshape(len(frames), SAMPLE_POINTS, 2)
+            else:
+                frame_samples = np.empty((len(frames), SAMPLE_POINTS, 2), dtype=np.int16)
+                for frame, frame_out in zip(frames, frame_samples):
+                    raster.convert_frame(frame, frame_out)
+    finally:
+        for name, function in raster_originals.items():
+            setattr(raster, name, function)
+
+    height, width = frames[0].shape
+    time_wav_write(frame_samples, width - 1 + max(raster.x_values), height, stage_seconds)
+    return stage_seconds, {}
+
+"""
+Runs each frame through process_bmp exactly as the converter does (carrying the density limits on from frame to frame in groups of WARM_START_FRAMES) with
+its stages wrapped in timers. The density search is whatever time process_bmp spends outside of the other stages.
+With incremental the frames go through thread_wrapped_bmp_convert together like a worker's batch, so with the contour tracer
+each one after the first only retraces the tiles that changed since the one before
+"""
+def bench_vector(frames, tracer, incremental=False):
+    stage_seconds = {}
+    notes = {}
+    vector.SAMPLE_POINTS = SAMPLE_POINTS
+    vector.TRACER = tracer
+    originals = dict(vector_originals)
+    stage_names = {"trace_frame": "trace", "frame_segments": "segments", "order_segments": "ordering", "sample_segments": "sampling"}
+
+    missing_fixtures = []
+    if(tracer == "potrace"):
+        have_potrace = os.path.isfile(vector.POTRACE_PATH)
+        notes["potrace"] = "live" if have_potrace else "replayed from fixtures"
+
+        #Potrace if we have it (recording what it gives), otherwise the recorded SVG for exactly this frame and these settings
+        def fixture_trace(frame, t_size):
+            fixture_path = os.path.join(FIXTURE_FOLDER, frame_key(frame, ("potrace", t_size, vector.A_QUALITY, vector.OPT_TOLERANCE)) + ".svg")
+            if(have_potrace):
+                svg = potrace_svg(frame, t_size, vector.A_QUALITY, vector.OPT_TOLERANCE, vector.POTRACE_PATH)
+                if(RECORD_FIXTURES):
+                    os.makedirs(FIXTURE_FOLDER, exist_ok=True)
+                    with open(fixture_path, "wb") as f:
+                        f.write(svg)
+            elif(os.path.isfile(fixture_path)):
+                with open(fixture_path, "rb") as f:
+                    svg = f.read()
+            else:
+                missing_fixtures.append(fixture_path)
+                raise FileNotFoundError(fixture_path)
+            return parse_svg_paths(svg)
+        originals["trace_frame"] = fixture_trace
+
+    #The incremental tracer traces without going through trace_frame, so time its trace instead
+    def timed_contour_tracer(*args, **kwargs):
+        contour_tracer = ContourTracer(*args, **kwargs)
+        contour_tracer.trace = timed(stage_seconds, "trace", contour_tracer.trace)
+        return contour_tracer
+    originals["ContourTracer"] = timed_contour_tracer
+    originals["process_bmp"] = timed(stage_seconds, "process_bmp", vector.process_bmp)
+
+    for name, function in originals.items():
+        setattr(vector, name, timed(stage_seconds, stage_names[name], function) if name in stage_names else function)
+    vector.INCREMENTAL_TILE_SIZE = INCREMENTAL_TILE_SIZE
+
+    frame_samples = []
+    level = vector.logger.level
+    vector.logger.setLevel(logging.CRITICAL + 1)    #process_bmp's debug output would swamp the report
+    try:
+        if(incremental):
+            chunk_points, _, chunk_metrics = vector.thread_wrapped_bmp_convert(list(enumerate(frames, 1)))
+            frame_samples = list(chunk_points.reshape(-1, SAMPLE_POINTS, 2))
+            loops_reused = [metrics["loops_reused"] for metrics in chunk_metrics if metrics["loops_reused"] is not None]
+            if(loops_reused):
+                notes["loops_reused"] = sum(loops_reused)
+        else:
+            for frame_number, frame in enumerate(frames, 1):
+                if((frame_number - 1) % vector.WARM_START_FRAMES == 0):
+                    density_upper_limit, density_lower_limit = 1, vector.DENSITY_ABSOLUTE_LOWER_LIMIT
+                try:
+                    frame_points, density_upper_limit, density_lower_limit, _ = vector.process_bmp(frame, frame_number, vector.T_QUALITY, density_upper_limit, density_lower_limit)
+                except FileNotFoundError:
+                    continue
+                frame_samples.append(frame_points)
+    finally:
+        vector.logger.setLevel(level)
+        for name, function in vector_originals.items():
+            setattr(vector, name, function)
+
+    stage_seconds["density_search"] = stage_seconds.pop("process_bmp", 0) - sum(stage_seconds.get(stage, 0) for stage in stage_names.values())
+    if(missing_fixtures):
+        notes["missing_fixtures"] = len(missing_fixtures)
+    notes["frames_converted"] = len(frame_samples)
+    if(frame_samples):
+        height, width = frames[0].shape
+        time_wav_write(frame_samples, width*SVG_UNITS_PER_PIXEL, height*SVG_UNITS_PER_PIXEL, stage_seconds)
+    return stage_seconds, notes
+
+#Print how each case and stage compares to a baseline report (ratio > 1 means faster now)
+def compare(results, baseline):
+    print(f"\nCompared to baseline from {baseline['settings'].get('date', '?')} (x > 1 is faster now):")
+    for case, result in results["cases"].items():
+        old = baseline["cases"].get(case)
+        if(old is None or not old.get("frames_per_second") or not result.get("frames_per_second")):
+            continue
+        stages = []
+        for stage, seconds in result["stage_seconds"].items():
+            old_seconds = old["stage_seconds"].get(stage)
+            if(old_seconds and seconds > 0):
+                stages.append(f"{stage} x{old_seconds/seconds:.2f}")
+        if(old.get("potrace") != result.get("potrace")):
+            stages.append(f"(potrace {result['potrace']} now but {old.get('potrace')} before, so trace times aren't comparable)")
+        print(f"  {case}: {result['frames_per_second']:.2f} fps vs {old['frames_per_second']:.2f} (x{result['frames_per_second']/old['frames_per_second']:.2f}) | {', '.join(stages)}")
+
+#Converts FRAMES_PER_CASE frames of one kind at one size with one converter and returns the case's results
+def run_case(converter, kind, width, height):
+    frames = synthetic_frames(kind, width, height, FRAMES_PER_CASE)
+    base_converter, _, mode = converter.partition("_")
+    start_time = time.perf_counter()
+    if(base_converter == "raster"):
+        stage_seconds, notes = bench_raster(frames, mode == "incremental")
+    else:
+        stage_seconds, notes = bench_vector(frames, base_converter, mode == "incremental")
+    seconds = time.perf_counter() - start_time
+
+    converted = notes.get("frames_converted", len(frames))
+    result = {"frames": converted, "seconds": seconds, "stage_seconds": stage_seconds, "peak_rss_mb": peak_rss_mb(), **notes}
+    if(converted > 0):
+        result["frames_per_second"] = converted/seconds
+        result["samples_per_second"] = converted*SAMPLE_POINTS/seconds
+    return result
+
+
+
+
+########USER VARIABLES START########
+
+SAMPLE_RATE = 96000         #Same meaning as in the converters, gives the point budget per frame with FPS
+FPS = 15
+RESOLUTIONS = [(107, 80), (480, 360), (960, 720)]   #(width, height) of the synthetic frames
+KINDS = ["shapes", "text", "noise", "dither", "silhouette", "walker"]
+FRAMES_PER_CASE = 8         #Frames of each kind at each resolution. More gives steadier numbers but takes longer
+CONVERTERS = ["raster", "raster_incremental", "contour", "contour_incremental", "potrace"]   #"raster", or "contour"/"potrace" for the vector converter with that TRACER. "_incremental" converts each case's frames as one batch of consecutive frames, only redoing what changed between them
+INCREMENTAL_TILE_SIZE = 32  #Tile size for "contour_incremental", as in the vector converter
+SKIP_VECTOR_KINDS = ["noise"]   #Random noise takes minutes per frame to vectorise at the larger sizes, so isn't much use as a benchmark there
+
+OUTPUT_PATH = "bench_results.json"  #Where to save this run's results
+BASELINE_PATH = None        #An earlier run's results to compare against, e.g. "bench_baseline.json"
+FIXTURE_FOLDER = "bench_fixtures"   #Recorded potrace SVGs, used when potrace isn't installed
+RECORD_FIXTURES = True      #Save potrace's output to FIXTURE_FOLDER whenever it is installed
+
+########USER VARIABLES END########
+
+
+
+
+SAMPLE_POINTS = int(SAMPLE_RATE/FPS)
+CWD = os.getcwd()
+#The stage functions before they're wrapped in timers, to put back after each case
+raster_originals = {name: getattr(raster, name) for name in ("extract_runs", "update_runs", "prune_runs", "allocate_repeats", "emit_frame")}
+vector_originals = {name: getattr(vector, name) for name in ("trace_frame", "frame_segments", "order_segments", "sample_segments", "ContourTracer", "process_bmp")}
+
+if __name__ == '__main__':
+    results = {"settings": {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "sample_points": SAMPLE_POINTS, "frames_per_case": FRAMES_PER_CASE,
+                            "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()},
+               "cases": {}}
+
+    #A fresh interpreter per case (spawn rather than fork) so no case starts out with memory left over from this one
+    spawn = multiprocessing.get_context("spawn")
+    for width, height in RESOLUTIONS:
+        for kind in KINDS:
+            for converter in CONVERTERS:
+                case = f"{converter}/{kind}/{width}x{height}"
+                if(not converter.startswith("raster") and kind in SKIP_VECTOR_KINDS):
+                    continue
+
+                with spawn.Pool(1) as p:
+                    result = p.apply(run_case, (converter, kind, width, height))
+                if(result["frames"] > 0):
+                    print(f"{case}: {result['frames_per_second']:.2f} frames/s, {result['samples_per_second']:.0f} samples/s")
+                else:
+                    print(f"{case}: skipped, {result}")
+                results["cases"][case] = result
+
+    case_peaks = [result["peak_rss_mb"] for result in results["cases"].values() if result["peak_rss_mb"] is not None]
+    results["peak_rss_mb"] = max(case_peaks) if case_peaks else None
+    with open(os.path.join(CWD, OUTPUT_PATH), "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {OUTPUT_PATH}, peak memory {results['peak_rss_mb']} MB")
+
+    if(BASELINE_PATH is not None):
+        with open(os.path.join(CWD, BASELINE_PATH)) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import numpy as np
+import hashlib, os
+
+#Key for a frame's finished samples: a hash of its binarized pixels (and size) plus every setting that changes how it's converted
+def frame_key(frame, settings):
+    frame_hash = hashlib.blake2b(digest_size=16)
+    frame_hash.update(repr((frame.shape, settings)).encode())
+    frame_hash.update(np.packbits(frame).tobytes())
+    return frame_hash.hexdigest()
+
+#Whether a frame is close enough to the reference frame (at most max_pixels differ) to just reuse its samples
+def is_static(frame, reference, max_pixels):
+    return reference is not None and frame.shape == reference.shape and np.count_nonzero(frame != reference) <= max_pixels
+
+"""
+Least recently used cache of finished per-frame sample blocks keyed by frame_key, so repeated frames (held frames, loops or
+re-renders with the same settings) are only ever converted once. Blocks are kept in memory up to max_bytes and, if a folder
+is given, also saved there as .npy files up to max_disk_bytes so they last between runs. The oldest entries are evicted first.
+"""
+class FrameCache:
+    def __init__(self, max_bytes, folder=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self.disk = OrderedDict()   #key -> file size, oldest first
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if(folder is not None):
+            os.makedirs(folder, exist_ok=True)
+            entries = [entry for entry in os.scandir(folder) if entry.name.endswith(".npy")]
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                self.disk[entry.name[:-4]] = entry.stat().st_size
+                self.disk_bytes += entry.stat().st_size
+
+    def disk_path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    #Returns the cached block for this key, or None if we don't have it
+    def get(self, key):
+        if(key in self.memory):
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if(key in self.disk):
+            try:
+                block = np.load(self.disk_path(key))
+            except (OSError, ValueError):
+                self.forget_disk(key)   #Deleted or half written by another run, just convert it again
+            else:
+                self.disk.move_to_end(key)
+                os.utime(self.disk_path(key))   #So it counts as recently used next run too
+                self.remember(key, block)
+                self.hits += 1
+                return block
+
+        self.misses += 1
+        return None
+
+    def put(self, key, block):
+        self.remember(key, block)
+        if(self.folder is not None and key not in self.disk and block.nbytes <= self.max_disk_bytes):
+            temp_path = self.disk_path(key) + ".tmp"
+            with open(temp_path, "wb") as f:
+                np.save(f, block)
+            os.replace(temp_path, self.disk_path(key))
+            self.disk[key] = os.path.getsize(self.disk_path(key))
+            self.disk_bytes += self.disk[key]
+            while self.disk_bytes > self.max_disk_bytes:
+                oldest = next(iter(self.disk))
+                self.forget_disk(oldest)
+                try:
+                    os.remove(self.disk_path(oldest))
+                except OSError:
+                    pass
+
+    #Add to the in memory part, evicting the least recently used blocks to stay under max_bytes
+    def remember(self, key, block):
+        if(block.nbytes > self.max_bytes):
+            return
+        if(key in self.memory):
+            self.memory_bytes -= self.memory.pop(key).nbytes
+        self.memory[key] = block
+        self.memory_bytes += block.nbytes
+        while self.memory_bytes > self.max_bytes:
+            self.memory_bytes -= self.memory.popitem(last=False)[1].nbytes
+
+    def forget_disk(self, key):
+        self.disk_bytes -= self.disk.pop(key)
@@ -0,0 +1,56 @@
+from PIL import Image
+import numpy as np
+import os, glob
+import subprocess
+
+#Get every file with the given extension in a folder sorted numerically (1.png, 2.png ... 10.png)
+def folder_frame_paths(folder, extension):
+    paths = glob.glob(os.path.join(folder, "*." + extension))
+    paths.sort(key=lambda x: int(os.path.basename(x).split('.')[0]))
+    return paths
+
+#Load each image in a folder as a 2D boolean array where True = white
+def folder_frames(folder, extension, threshold=128):
+    for path in folder_frame_paths(folder, extension):
+        with Image.open(path) as img:
+            yield np.asarray(img.convert("L")) >= threshold
+
+#Ask ffprobe for the width and height of the first video stream
+def probe_size(video_path, ffprobe="ffprobe"):
+    output = subprocess.run([ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", video_path],
+                            capture_output=True, text=True, check=True).stdout
+    width, height = output.strip().split(",")[:2]
+    return int(width), int(height)
+
+"""
+Decodes a video with ffmpeg straight into 2D boolean arrays (True = white) one frame at a time, without writing any images to disk.
+ffmpeg resamples to the given fps, scales to the given height (keeping the aspect ratio, None = source height) and hands us
+8 bit grey frames over a pipe which are then thresholded in memory.
+"""
+def video_frames(video_path, fps, height=None, threshold=128, ffmpeg="ffmpeg", ffprobe="ffprobe"):
+    source_width, source_height = probe_size(video_path, ffprobe)
+    if(height is None):
+        width, height = source_width, source_height
+    else:
+        width = max(1, round(source_width*height/source_height))  #Same as ffmpeg's scale=-1
+
+    command = [ffmpeg, "-v", "error", "-i", video_path, "-vf", f"fps={fps},scale={width}:{height}", "-f", "rawvideo", "-pix_fmt", "gray", "-"]
+    frame_size = width*height
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if(len(data) < frame_size):
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(height, width) >= threshold
+    finally:
+        #Stop ffmpeg if we've been closed early, otherwise it's already finished
+        process.stdout.close()
+        if(process.poll() is None):
+            process.kill()
+        process.wait()
+
+#Encode a boolean frame (True = white) as a binary PBM, which potrace reads as black = 1
+def frame_to_pbm(frame):
+    height, width = frame.shape
+    return f"P4\n{width} {height}\n".encode() + np.packbits(~frame, axis=1).tobytes()
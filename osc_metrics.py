@@ -0,0 +1,64 @@
+import csv, json, heapq
+
+"""
+Writes one row of metrics per converted frame to a sidecar file as they come in, as CSV if the path ends in .csv and JSON
+lines otherwise. Also keeps running totals of every numeric field and the slowest frames (by their "seconds") for a summary
+at the end of the run, without holding every row in memory.
+"""
+class MetricsLog:
+    def __init__(self, path=None, slowest_count=10):
+        self.path = path
+        self.file = None
+        self.csv_writer = None
+        self.slowest_count = slowest_count
+        self.slowest = []   #Min heap of (seconds, order, row) so the quickest of the slowest is first to go
+        self.totals = {}
+        self.count = 0
+        if(path is not None):
+            self.file = open(path, "w", newline="")
+
+    def write(self, row):
+        if(self.file is not None):
+            if(self.path.endswith(".csv")):
+                if(self.csv_writer is None):
+                    #Rows can have optional fields so take the columns from the first one and ignore any others
+                    self.csv_writer = csv.DictWriter(self.file, fieldnames=list(row), extrasaction="ignore")
+                    self.csv_writer.writeheader()
+                self.csv_writer.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + "\n")
+
+        for field, value in row.items():
+            if(isinstance(value, (int, float)) and not isinstance(value, bool)):
+                self.totals[field] = self.totals.get(field, 0) + value
+        entry = (row.get("seconds", 0), self.count, row)
+        if(len(self.slowest) < self.slowest_count):
+            heapq.heappush(self.slowest, entry)
+        elif(self.slowest_count > 0):
+            heapq.heappushpop(self.slowest, entry)
+        self.count += 1
+
+    #Slowest frames first along with where their time went (any fields ending in _seconds)
+    def summary(self):
+        if(self.count == 0):
+            return "No frames converted"
+
+        lines = [f"Metrics for {self.count} converted frames" + (f" written to {self.path}" if self.path is not None else "")]
+        stage_totals = {field: value for field, value in self.totals.items() if field.endswith("_seconds")}
+        lines.append("Total time per stage: " + ", ".join(f"{field[:-8]} {value:.2f}s" for field, value in stage_totals.items()))
+        lines.append(f"Slowest {len(self.slowest)} frames:")
+        for seconds, _, row in sorted(self.slowest, key=lambda entry: -entry[0]):
+            stages = ", ".join(f"{field[:-8]} {row[field]:.3f}s" for field in stage_totals if field in row)
+            details = ", ".join(f"{field} {row[field]}" for field in ("search_iterations", "t_escalations", "points") if field in row)
+            lines.append(f"  frame {row.get('frame')}: {seconds:.3f}s ({stages}) {details}")
+        return "\n".join(lines)
+
+    def close(self):
+        if(self.file is not None):
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
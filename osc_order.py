@@ -0,0 +1,181 @@
+"""
+Beam path ordering. Tracers give a frame's subpaths in whatever order they found them, and every jump from the end of one
+subpath to the start of the next is drawn by the beam as a faint retrace line across the picture. Here the subpaths are put
+into a nearest neighbour order (reversing them where that's closer), improved with 2-opt, and closed subpaths are started
+from whichever of their vertices is nearest to where the beam already is, to keep those jumps as short as possible.
+"""
+import numpy as np
+from osc_segments import Segments, LINE, QUADRATIC, CUBIC, ARC, MOVE, evaluate
+
+#Optional, only makes the nearest neighbour search quicker on frames with lots of subpaths
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+#Start and end point of every segment (arcs only store their center so these have to be evaluated)
+def segment_endpoints(segments):
+    starts = segments.controls[:, 0].copy()
+    ends = segments.controls[:, 1].copy()
+    for kind in (QUADRATIC, CUBIC, ARC):
+        indices = np.flatnonzero(segments.kinds == kind)
+        if(len(indices) > 0):
+            starts[indices] = evaluate(kind, segments.controls[indices], np.zeros(len(indices)))
+            ends[indices] = evaluate(kind, segments.controls[indices], np.ones(len(indices)))
+    return starts, ends
+
+#The same segments drawn from end to start
+def reverse_controls(kinds, controls):
+    reversed_controls = controls.copy()
+    for kind, columns in ((LINE, [1, 0]), (MOVE, [1, 0]), (QUADRATIC, [2, 1, 0]), (CUBIC, [3, 2, 1, 0])):
+        rows = kinds == kind
+        reversed_controls[np.ix_(rows, range(len(columns)))] = controls[np.ix_(rows, columns)]
+
+    arcs = kinds == ARC
+    angles = controls[arcs, 2]
+    reversed_controls[arcs, 2] = (angles.real + angles.imag) - angles.imag*1j    #Start where it used to end and sweep back
+    return reversed_controls
+
+#(first, stop) segment range of each subpath, split wherever there's a Move and leaving the Moves themselves out
+def split_subpaths(kinds):
+    moves = np.flatnonzero(kinds == MOVE)
+    firsts = np.concatenate([[0], moves + 1])
+    stops = np.concatenate([moves, [len(kinds)]])
+    keep = stops > firsts
+    return list(zip(firsts[keep].tolist(), stops[keep].tolist()))
+
+"""
+Greedy tour through the subpaths (given by their start and end points) from the first one, always going to the nearest
+unvisited start or end point next and drawing that subpath backwards if it was an end point. Returns the visiting order and
+which of them are reversed
+"""
+def nearest_neighbour_tour(starts, ends):
+    count = len(starts)
+    endpoints = np.concatenate([starts, ends])  #i is the start of subpath i, count+i its end
+    tree = None
+    if(cKDTree is not None):
+        tree = cKDTree(np.stack([endpoints.real, endpoints.imag], axis=1))
+
+    visited = np.zeros(count, dtype=bool)
+    visited[0] = True
+    order = [0]
+    reversed_subpaths = [False]
+    current = ends[0]
+    for _ in range(count - 1):
+        if(tree is not None):
+            #Ask for more and more neighbours until one of them hasn't been visited yet
+            k = 8
+            while True:
+                k = min(k, len(endpoints))
+                _, neighbours = tree.query([current.real, current.imag], k=k)
+                neighbours = np.atleast_1d(neighbours)
+                neighbours = neighbours[~visited[neighbours % count]]
+                if(len(neighbours) > 0 or k == len(endpoints)):
+                    break
+                k *= 4
+            nearest = int(neighbours[0])
+        else:
+            distances = np.abs(endpoints - current)
+            distances[np.tile(visited, 2)] = np.inf
+            nearest = int(np.argmin(distances))
+
+        subpath = nearest % count
+        backwards = nearest >= count
+        visited[subpath] = True
+        order.append(subpath)
+        reversed_subpaths.append(backwards)
+        current = starts[subpath] if backwards else ends[subpath]
+
+    return np.array(order), np.array(reversed_subpaths)
+
+"""
+2-opt on an open tour: reversing any run of subpaths i..j (which also flips each of their directions) only changes the jump
+into i and the jump out of j, so for each i every j is checked at once and the best improvement taken. Repeats until
+nothing improves or max_passes is reached. entries/exits are where the beam enters and leaves each subpath in tour order
+"""
+def two_opt(order, reversed_subpaths, entries, exits, max_passes):
+    count = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(count - 1):
+            j = np.arange(i + 1, count)
+            after = np.minimum(j + 1, count - 1)
+            has_after = j + 1 < count
+
+            old = np.where(has_after, np.abs(exits[j] - entries[after]), 0)
+            new = np.where(has_after, np.abs(entries[i] - entries[after]), 0)
+            if(i > 0):
+                old = old + np.abs(exits[i-1] - entries[i])
+                new = new + np.abs(exits[i-1] - exits[j])
+
+            gains = old - new
+            best = int(np.argmax(gains))
+            if(gains[best] > 1e-9):
+                j = int(j[best])
+                order[i:j+1] = order[i:j+1][::-1].copy()
+                reversed_subpaths[i:j+1] = ~reversed_subpaths[i:j+1][::-1]
+                entries[i:j+1], exits[i:j+1] = exits[i:j+1][::-1].copy(), entries[i:j+1][::-1].copy()
+                improved = True
+
+        if(not improved):
+            break
+
+    return order, reversed_subpaths, entries, exits
+
+#Total distance the beam jumps between subpaths drawn with the given entry/exit points
+def travel_distance(entries, exits):
+    return float(np.sum(np.abs(entries[1:] - exits[:-1])))
+
+"""
+Reorder a frame's Segments to cut the distance the beam travels between subpaths, returning the reordered Segments (without
+their Moves) and the travel distance before and after. Segment lengths are unchanged so it never changes how many points a
+density gives.
+"""
+def order_segments(segments, max_passes=8):
+    subpaths = split_subpaths(segments.kinds)
+    drawn = segments.kinds != MOVE
+    if(len(subpaths) == 0):
+        return Segments(segments.kinds[drawn], segments.controls[drawn], segments.lengths[drawn]), 0.0, 0.0
+
+    segment_starts, segment_ends = segment_endpoints(segments)
+    firsts = np.array([first for first, stop in subpaths])
+    lasts = np.array([stop - 1 for first, stop in subpaths])
+    starts, ends = segment_starts[firsts], segment_ends[lasts]
+    travel_before = travel_distance(starts, ends)
+
+    order, reversed_subpaths = nearest_neighbour_tour(starts, ends)
+    entries = np.where(reversed_subpaths, ends[order], starts[order])
+    exits = np.where(reversed_subpaths, starts[order], ends[order])
+    order, reversed_subpaths, entries, exits = two_opt(order, reversed_subpaths, entries, exits, max_passes)
+
+    #Closed subpaths can start from any of their vertices. Going through in order, pick the one that gives the shortest jumps
+    #in from the last subpath and out to the next (which only ever shortens the tour)
+    closed = np.isclose(starts, ends)
+    indices = []
+    flips = []
+    for position, (subpath, backwards) in enumerate(zip(order, reversed_subpaths)):
+        first, stop = subpaths[subpath]
+        subpath_indices = np.arange(first, stop)
+        if(backwards):
+            subpath_indices = subpath_indices[::-1]
+
+        if(closed[subpath] and stop - first > 1):
+            vertices = segment_ends[subpath_indices] if backwards else segment_starts[subpath_indices]
+            jumps = np.zeros(len(vertices))
+            if(position > 0):
+                jumps += np.abs(vertices - exits[position-1])
+            if(position + 1 < len(order)):
+                jumps += np.abs(vertices - entries[position+1])
+            start_vertex = int(np.argmin(jumps))
+            subpath_indices = np.roll(subpath_indices, -start_vertex)
+            entries[position] = exits[position] = vertices[start_vertex]
+
+        indices.append(subpath_indices)
+        flips.append(np.full(len(subpath_indices), backwards))
+
+    indices = np.concatenate(indices)
+    flips = np.concatenate(flips)
+    kinds = segments.kinds[indices]
+    controls = segments.controls[indices]
+    controls[flips] = reverse_controls(kinds[flips], controls[flips])
+    return Segments(kinds, controls, segments.lengths[indices]), travel_before, travel_distance(entries, exits)
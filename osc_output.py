@@ -0,0 +1,244 @@
+import numpy as np
+import os, sys, time, queue, threading, struct
+
+#Sample formats we can write: (bytes per sample, largest amplitude). Floats go from -1 to 1
+SAMPLE_FORMATS = {"s16": (2, 32767), "s24": (3, 8388607), "f32": (4, 1.0)}
+
+"""
+Map frame coordinates in the range [0, x_extent] / [0, y_extent] onto the signed range centered around 0 for the given
+largest amplitude (slightly under the format's limit to account for the lower signed range and any rounding errors).
+Works in place on out (a (points, 2) float64 array, made if not given) so no temporaries are needed. Kept in float64 rather
+than float32 as float32 rounding changes where many values truncate to when stored as integers
+"""
+def scale_frame(frame, x_extent, y_extent, full_scale=32767, out=None):
+    if(out is None):
+        out = np.empty(np.shape(frame), dtype=np.float64)
+    scale = np.array([2*full_scale/max(x_extent, 1), 2*full_scale/max(y_extent, 1)])
+    np.multiply(frame, scale, out=out)
+    out -= full_scale
+    return np.clip(out, -full_scale, full_scale, out=out)
+
+#Stereo .wav header for the given sample format and number of samples (float formats need the extra fact chunk)
+def wav_header(sample_rate, sample_format, samples):
+    sample_bytes = SAMPLE_FORMATS[sample_format][0]
+    data_bytes = min(samples*2*sample_bytes, 0xFFFFFFFF - 58)    #Past 4GB the sizes are just left at the max, which most players cope with
+    if(sample_format == "f32"):
+        fmt = struct.pack("<HHIIHHH", 3, 2, sample_rate, sample_rate*2*sample_bytes, 2*sample_bytes, 8*sample_bytes, 0)
+        extra = b"fact" + struct.pack("<II", 4, min(samples, 0xFFFFFFFF))
+    else:
+        fmt = struct.pack("<HHIIHH", 1, 2, sample_rate, sample_rate*2*sample_bytes, 2*sample_bytes, 8*sample_bytes)
+        extra = b""
+    chunks = b"fmt " + struct.pack("<I", len(fmt)) + fmt + extra + b"data" + struct.pack("<I", data_bytes)
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks) + data_bytes) + b"WAVE" + chunks
+
+"""
+Writes frames as they're finished to a stereo 16 bit, 24 bit or float32 .wav, or with any other extension to a headerless raw
+file of just the interleaved little endian samples (e.g. output.f32 / output.s16), instead of holding the whole video in memory.
+A raw file named after a sample format has to be in that format, so output.f32 can't quietly end up holding 16 bit samples.
+The file is memory mapped and grown in large steps as it fills, and each frame is scaled straight into its place in the map
+through one reused float64 buffer, so even 192kHz+ renders don't need any full length copies in RAM.
+As we can't look at every sample before writing the scale is instead fixed by the largest x/y coordinate a frame can
+have (i.e. its width and height) which also keeps the picture from jumping around between frames. A .wav header is
+written with 0 samples to start with and fixed up with the real length (and the file trimmed to it) when it's closed.
+"""
+class SampleFile:
+    def __init__(self, path, sample_rate, x_extent, y_extent, sample_format="s16"):
+        if(sample_format not in SAMPLE_FORMATS):
+            raise ValueError(f"Unknown sample format: {sample_format}")
+        extension = os.path.splitext(path)[1].lower()[1:]
+        if(extension in SAMPLE_FORMATS and extension != sample_format):
+            raise ValueError(f"{os.path.basename(path)} would hold {sample_format} samples, set the sample format to {extension} or rename it")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.x_extent = x_extent
+        self.y_extent = y_extent
+        self.sample_format = sample_format
+        self.sample_bytes, self.full_scale = SAMPLE_FORMATS[sample_format]
+        self.is_wav = path.lower().endswith(".wav")
+        self.header_bytes = len(wav_header(sample_rate, sample_format, 0)) if self.is_wav else 0
+        self.samples = 0
+        self.capacity = 0
+        self.map = None
+        self.buffer = np.empty((0, 2), dtype=np.float64)
+
+        with open(path, "wb") as f:
+            if(self.is_wav):
+                f.write(wav_header(sample_rate, sample_format, 0))
+
+    #Extend the file to fit at least the given number of samples and map the sample part of it again
+    def grow(self, samples):
+        self.capacity = max(samples, 2*self.capacity, 10*self.sample_rate)   #At least 10 seconds at a time
+        if(self.map is not None):
+            self.map.flush()
+            self.map = None  #Has to be unmapped before resizing on Windows
+        with open(self.path, "r+b") as f:
+            f.truncate(self.header_bytes + self.capacity*2*self.sample_bytes)
+
+        if(self.sample_format == "s24"):
+            self.map = np.memmap(self.path, dtype=np.uint8, mode="r+", offset=self.header_bytes, shape=(self.capacity, 2, 3))
+        else:
+            dtype = "<f4" if self.sample_format == "f32" else "<i2"
+            self.map = np.memmap(self.path, dtype=dtype, mode="r+", offset=self.header_bytes, shape=(self.capacity, 2))
+
+    #frame is a (points, 2) array of x/y coordinates
+    def write(self, frame):
+        points = len(frame)
+        if(self.samples + points > self.capacity):
+            self.grow(self.samples + points)
+        if(len(self.buffer) != points):
+            self.buffer = np.empty((points, 2), dtype=np.float64)
+
+        scaled = scale_frame(frame, self.x_extent, self.y_extent, self.full_scale, out=self.buffer)
+        target = self.map[self.samples:self.samples + points]
+        if(self.sample_format == "s24"):
+            target[...] = scaled.astype("<i4").view(np.uint8).reshape(points, 2, 4)[:, :, :3]   #Low 3 bytes of each little endian int32
+        else:
+            target[...] = scaled    #Truncates towards 0 for the integer formats like astype would
+        self.samples += points
+
+    def close(self):
+        if(self.map is not None):
+            self.map.flush()
+            self.map = None
+        with open(self.path, "r+b") as f:
+            f.truncate(self.header_bytes + self.samples*2*self.sample_bytes)
+            if(self.is_wav):
+                f.seek(0)
+                f.write(wav_header(self.sample_rate, self.sample_format, self.samples))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#Binary file to stream raw samples to: "-" for stdout, anything else is a path (e.g. a named pipe made with mkfifo)
+#When it's stdout, file descriptor 1 is pointed at stderr for everything else (including worker processes) so prints can't end up mixed into the samples
+def open_stream_target(target):
+    if(target == "-"):
+        sys.stdout.flush()
+        stream_file = os.fdopen(os.dup(1), "wb")
+        os.dup2(2, 1)
+        return stream_file
+    return open(target, "wb")
+
+"""
+Streams frames live as raw interleaved little endian 16 bit stereo (the same samples a .wav would hold) to a binary file from
+open_stream_target, for feeding straight into an audio player/scope. Frames are queued up to lookahead deep and sent on a clock of one every 1/fps
+seconds once the queue is first full. Any frame not ready by its deadline is an underrun and the previous frame is sent again
+in its place, so the output never stalls. How many underruns there were and the latency from each frame being finished to
+being sent are reported when it's closed, to tell if a SAMPLE_RATE/FPS/resolution keeps up in real time.
+If sending fails the error is raised again on the main thread by the next write or close. A broken pipe just means whatever
+was reading has stopped, so the with block using the stream ends there quietly and the conversion stops early.
+"""
+class LiveStream:
+    def __init__(self, stream_file, fps, x_extent, y_extent, lookahead=8):
+        self.x_extent = x_extent
+        self.y_extent = y_extent
+        self.period = 1/fps
+        self.file = stream_file
+        self.queue = queue.Queue(maxsize=max(1, lookahead))
+        self.started = threading.Event()
+        self.frames = 0
+        self.underruns = 0
+        self.latencies = []
+        self.error = None   #Whatever stopped the sending thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #frame is a (points, 2) array of x/y coordinates. Blocks while the lookahead queue is full
+    def write(self, frame):
+        block = scale_frame(frame, self.x_extent, self.y_extent).astype("<h").tobytes()
+        self.put((block, time.perf_counter()))
+        if(self.queue.full()):
+            self.started.set()
+
+    #Queue an item, raising whatever stopped the sending thread rather than waiting forever for it to make room
+    def put(self, item):
+        while True:
+            if(self.error is not None):
+                raise self.error
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        try:
+            self.send()
+        except OSError as error:
+            self.error = error
+
+    def send(self):
+        self.started.wait()
+        start_time = time.perf_counter()
+        previous_block = None
+        tick = 0
+        while True:
+            deadline = start_time + tick*self.period
+            delay = deadline - time.perf_counter()
+            if(delay > 0):
+                time.sleep(delay)
+
+            if(previous_block is None):
+                item = self.queue.get()     #Nothing to repeat yet so just wait for the first frame
+            else:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = (previous_block, None)
+                    self.underruns += 1
+
+            if(item is None):
+                break   #Closed and everything before it sent
+            block, finished_time = item
+            self.file.write(block)
+            self.file.flush()
+            if(finished_time is not None):
+                self.latencies.append(time.perf_counter() - finished_time)
+                self.frames += 1
+            previous_block = block
+            tick += 1
+
+            #If whatever's reading is slower than real time then writing blocks, that's not our lateness so restart the clock
+            if(time.perf_counter() - deadline > self.period):
+                start_time = time.perf_counter() - tick*self.period
+
+    def summary(self):
+        text = f"Streamed {self.frames} frames, {self.underruns} underruns (previous frame repeated)"
+        if(self.latencies):
+            p50, p95, p99 = np.percentile(self.latencies, [50, 95, 99])*1000
+            text += f", latency p50 {p50:.1f}ms p95 {p95:.1f}ms p99 {p99:.1f}ms"
+        if(isinstance(self.error, BrokenPipeError)):
+            text += ", stopped early as the reader went away"
+        return text
+
+    #Sends everything still queued then closes the file, raising anything that stopped the sending thread
+    def close(self):
+        try:
+            self.put(None)
+        except OSError:
+            pass    #Already stopped, raised again below
+        self.started.set()
+        self.thread.join()
+        try:
+            self.file.close()
+        except OSError:
+            if(self.error is None):
+                raise   #Otherwise it's just the same failure again trying to flush what's left
+        print(self.summary(), file=sys.stderr)
+        if(self.error is not None):
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    #A broken pipe ends the with block quietly, any other error is passed on (unless something else is already being raised)
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self.close()
+        except OSError as error:
+            if(exc is None and not isinstance(error, BrokenPipeError)):
+                raise
+        return isinstance(self.error, BrokenPipeError) and exc is self.error
@@ -0,0 +1,122 @@
+"""
+Batch sampling of traced frames. Rather than asking svg.path for one point at a time, every segment of a frame is turned
+into a row of control points in a NumPy array along with its kind (Line, QuadraticBezier, CubicBezier or Arc). Lengths come
+from fixed order Gauss-Legendre quadrature and all the sample positions for a density are evaluated at once with Bernstein
+polynomials, giving the same points in the same order as stepping through each segment with svg.path.
+"""
+from svg.path.path import Linear, Move, QuadraticBezier, CubicBezier, Arc
+from collections import namedtuple
+import numpy as np
+
+LINE, QUADRATIC, CUBIC, ARC, MOVE = 0, 1, 2, 3, 4
+
+#kinds: (n,) segment kind, controls: (n, 4) complex control points, lengths: (n,) length of each segment
+#Lines are [start, end, -, -], quadratics [start, control, end, -], cubics [start, control1, control2, end] and arcs
+#[center, radius (rx + ry*j), theta + delta*j (degrees), rotation (degrees)] as svg.path parameterises them. Moves are
+#[point, point, -, -], never drawn (no length) but kept to mark where each subpath starts
+Segments = namedtuple("Segments", ["kinds", "controls", "lengths"])
+
+GAUSS_LEGENDRE_ORDER = 24
+gauss_nodes, gauss_weights = np.polynomial.legendre.leggauss(GAUSS_LEGENDRE_ORDER)
+gauss_nodes = (gauss_nodes + 1)/2   #Move from [-1, 1] to [0, 1]
+gauss_weights = gauss_weights/2
+
+#Control point row and kind for a single svg.path segment
+def segment_controls(segment):
+    if(isinstance(segment, CubicBezier)):
+        return CUBIC, [segment.start, segment.control1, segment.control2, segment.end]
+    elif(isinstance(segment, QuadraticBezier)):
+        return QUADRATIC, [segment.start, segment.control, segment.end, 0]
+    elif(isinstance(segment, Arc)):
+        #svg.path treats arcs that go nowhere as a point and ones with no radius as straight lines
+        if(segment.start == segment.end):
+            return LINE, [segment.start, segment.start, 0, 0]
+        if(segment.radius.real == 0 or segment.radius.imag == 0):
+            return LINE, [segment.start, segment.end, 0, 0]
+        return ARC, [segment.center, segment.radius*segment.radius_scale, complex(segment.theta, segment.delta), segment.rotation]
+    elif(isinstance(segment, Linear)):
+        return LINE, [segment.start, segment.end, 0, 0]
+    elif(isinstance(segment, Move)):
+        return MOVE, [segment.start, segment.end, 0, 0]
+    raise TypeError(f"Unknown segment type: {type(segment).__name__}")
+
+#Evaluate the positions (t in [0, 1]) of segments of one kind, where controls has a row for each t
+def evaluate(kind, controls, t):
+    if(kind == LINE or kind == MOVE):
+        return controls[:, 0] + (controls[:, 1] - controls[:, 0])*t
+    elif(kind == QUADRATIC):
+        return (1 - t)**2*controls[:, 0] + 2*(1 - t)*t*controls[:, 1] + t**2*controls[:, 2]
+    elif(kind == CUBIC):
+        return (1 - t)**3*controls[:, 0] + 3*(1 - t)**2*t*controls[:, 1] + 3*(1 - t)*t**2*controls[:, 2] + t**3*controls[:, 3]
+
+    center, radius, angles, rotation = controls[:, 0], controls[:, 1], controls[:, 2], np.radians(controls[:, 3].real)
+    angle = np.radians(angles.real + angles.imag*t)
+    x = np.cos(rotation)*np.cos(angle)*radius.real - np.sin(rotation)*np.sin(angle)*radius.imag
+    y = np.sin(rotation)*np.cos(angle)*radius.real + np.cos(rotation)*np.sin(angle)*radius.imag
+    return center + x + y*1j
+
+#Derivative with respect to t, only needed for the curved kinds to measure their length
+def derivative(kind, controls, t):
+    if(kind == QUADRATIC):
+        return 2*((1 - t)*(controls[:, 1] - controls[:, 0]) + t*(controls[:, 2] - controls[:, 1]))
+    elif(kind == CUBIC):
+        return 3*((1 - t)**2*(controls[:, 1] - controls[:, 0]) + 2*(1 - t)*t*(controls[:, 2] - controls[:, 1]) + t**2*(controls[:, 3] - controls[:, 2]))
+
+    radius, angles, rotation = controls[:, 1], controls[:, 2], np.radians(controls[:, 3].real)
+    angle = np.radians(angles.real + angles.imag*t)
+    dx = -np.cos(rotation)*np.sin(angle)*radius.real - np.sin(rotation)*np.cos(angle)*radius.imag
+    dy = -np.sin(rotation)*np.sin(angle)*radius.real + np.cos(rotation)*np.cos(angle)*radius.imag
+    return (dx + dy*1j)*np.radians(angles.imag)
+
+#Length of each segment, exact for lines and by quadrature over the Gauss-Legendre nodes for everything else
+def measure(kinds, controls):
+    lengths = np.abs(controls[:, 1] - controls[:, 0])
+    for kind in (QUADRATIC, CUBIC, ARC):
+        indices = np.flatnonzero(kinds == kind)
+        if(len(indices) > 0):
+            kind_controls = np.repeat(controls[indices], GAUSS_LEGENDRE_ORDER, axis=0)
+            t = np.tile(gauss_nodes, len(indices))
+            speeds = np.abs(derivative(kind, kind_controls, t)).reshape(-1, GAUSS_LEGENDRE_ORDER)
+            lengths[indices] = speeds @ gauss_weights
+    return lengths
+
+#Turn the list of svg.path Paths a tracer gives for a frame into Segments
+def frame_segments(doc):
+    kinds = []
+    controls = []
+    for element in doc:
+        for path in element:
+            kind, row = segment_controls(path)
+            kinds.append(kind)
+            controls.append(row)
+
+    kinds = np.array(kinds, dtype=np.int8)
+    controls = np.array(controls, dtype=complex).reshape(-1, 4)
+    return Segments(kinds, controls, measure(kinds, controls))
+
+#How many points sample_segments would give for this density, without actually generating them (each segment gets int(length*density))
+def count_points(lengths, density):
+    return int(np.sum(np.floor(lengths*density)))
+
+"""
+Sample every segment at the given density, giving an (n, 2) array of x/y points in segment order. Each segment gets
+int(length*density) evenly spaced positions from its start to its end, a single point at its start if that's 1, and none at
+all if it's too small to worry about for this density (which saves quite a few points to spend on higher density instead).
+"""
+def sample_segments(segments, density):
+    steps = np.floor(segments.lengths*density).astype(np.int64)
+    total = int(np.sum(steps))
+
+    #Which segment each sample belongs to, and how far along it we are
+    sample_segment = np.repeat(np.arange(len(steps)), steps)
+    step_index = np.arange(total) - np.repeat(np.cumsum(steps) - steps, steps)
+    t = step_index/np.repeat(np.maximum(steps - 1, 1), steps)
+
+    points = np.empty(total, dtype=complex)
+    sample_kinds = segments.kinds[sample_segment]
+    for kind in (LINE, QUADRATIC, CUBIC, ARC):
+        mask = sample_kinds == kind
+        if(np.any(mask)):
+            points[mask] = evaluate(kind, segments.controls[sample_segment[mask]], t[mask])
+
+    return np.stack([points.real, points.imag], axis=1)
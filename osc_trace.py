@@ -0,0 +1,265 @@
+"""
+Tracers turn a frame (2D boolean array, True = white) into the outlines of its dark areas as a list of svg.path Paths.
+Every tracer is called as tracer(frame, t_size, ...) where outlines with an area of t_size pixels or less are dropped, and
+gives its coordinates in potrace's SVG units (1/10ths of a pixel, y pointing up) so they're interchangeable.
+"""
+from svg.path import parse_path
+from svg.path.path import Path, Move, Line
+from xml.dom import minidom
+import numpy as np
+import os, shutil, subprocess
+from osc_frames import frame_to_pbm
+from osc_segments import Segments, LINE, MOVE
+
+SVG_UNITS_PER_PIXEL = 10    #Potrace writes SVG coordinates in 1/10ths of a pixel
+
+#Used for silencing CMD window on Windows
+startupinfo = None
+if os.name == 'nt':
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+#Find potrace, preferring a copy in the given folder (e.g. CWD/potrace/potrace.exe) over one on the PATH
+def find_potrace(folder):
+    local_path = os.path.join(folder, "potrace.exe" if os.name == 'nt' else "potrace")
+    if(os.path.isfile(local_path)):
+        return local_path
+    return shutil.which("potrace") or local_path
+
+#Run potrace on a frame and return the SVG it gives. The frame is piped in as a PBM and the SVG read back from stdout so nothing touches the disk
+def potrace_svg(frame, t_size, a, opt_tolerance, potrace_path):
+    #-t (turdsize) only takes whole numbers, but T_QUALITY escalations make it a float
+    command = [potrace_path, "-", "-b", "svg", "-t", str(int(round(t_size))), "-a", str(a), "-O", str(opt_tolerance), "-o", "-"]
+    return subprocess.run(command, input=frame_to_pbm(frame), capture_output=True, check=True, startupinfo=startupinfo).stdout
+
+#Every <path> in an SVG document as an svg.path Path
+def parse_svg_paths(svg):
+    doc = minidom.parseString(svg)
+    paths = [parse_path(element.getAttribute("d")) for element in doc.getElementsByTagName("path")]
+    doc.unlink()
+    return paths
+
+#Potrace backend
+def trace_potrace(frame, t_size, a, opt_tolerance, potrace_path):
+    return parse_svg_paths(potrace_svg(frame, t_size, a, opt_tolerance, potrace_path))
+
+#Ramer-Douglas-Peucker: drop points from an open polyline that are within tolerance of the line between the points we keep
+def simplify_polyline(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points)-1)]
+    while stack:
+        i, j = stack.pop()
+        if(j - i < 2):
+            continue
+
+        chord = points[j] - points[i]
+        offsets = points[i+1:j] - points[i]
+        chord_length = np.hypot(chord[0], chord[1])
+        if(chord_length == 0):
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(chord[0]*offsets[:, 1] - chord[1]*offsets[:, 0])/chord_length
+
+        farthest = np.argmax(distances)
+        if(distances[farthest] > tolerance):
+            middle = i + 1 + farthest
+            keep[middle] = True
+            stack.append((i, middle))
+            stack.append((middle, j))
+
+    return points[keep]
+
+#Directions of each pixel edge as (dx, dy) in image coordinates (y down): East, South, West, North. (d+3)%4 is a left turn
+EDGE_DIRECTIONS = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+
+"""
+Follows the boundaries between dark and light pixels into closed loops, returning each as an (n, 2) array of its corner
+vertices in padded pixel coordinates along with its signed area. Every dark pixel side next to a light pixel is an edge
+pointing clockwise around the dark area, so each vertex has as many edges going out as coming in and they link up into loops.
+Where two dark pixels only touch diagonally we always turn left, which keeps them joined as one outline.
+"""
+def boundary_loops(frame):
+    dark = np.pad(~frame, 1)    #Outside the frame counts as light
+    width = dark.shape[1]
+
+    #Find each kind of edge, giving its start vertex (x, y) and direction
+    starts = []
+    directions = []
+    for direction, (dy, dx), (x_offset, y_offset) in [(0, (-1, 0), (0, 0)), (1, (0, 1), (1, 0)), (2, (1, 0), (1, 1)), (3, (0, -1), (0, 1))]:
+        ys, xs = np.nonzero(dark & ~np.roll(dark, (-dy, -dx), axis=(0, 1)))
+        starts.append(np.stack([xs + x_offset, ys + y_offset], axis=1))
+        directions.append(np.full(len(xs), direction))
+
+    starts = np.concatenate(starts)
+    directions = np.concatenate(directions)
+    if(len(starts) == 0):
+        return []
+
+    #Sort edges by start vertex then work out which one follows each edge from its end vertex
+    vertex_ids = starts[:, 1]*(width+1) + starts[:, 0]
+    order = np.lexsort((starts[:, 0], starts[:, 1]))
+    starts, directions, vertex_ids = starts[order], directions[order], vertex_ids[order]
+    ends = starts + EDGE_DIRECTIONS[directions]
+    end_ids = ends[:, 1]*(width+1) + ends[:, 0]
+    first_candidate = np.searchsorted(vertex_ids, end_ids, side="left")
+    candidate_count = np.searchsorted(vertex_ids, end_ids, side="right") - first_candidate
+    second_candidate = np.minimum(first_candidate + 1, len(starts) - 1)
+    takes_second = (candidate_count == 2) & (directions[second_candidate] == (directions + 3) % 4)
+    next_edge = np.where(takes_second, second_candidate, first_candidate)
+
+    #Walk each loop once, starting from its first edge in scan order
+    loops = []
+    visited = np.zeros(len(starts), dtype=bool)
+    next_edge = next_edge.tolist()
+    for first in range(len(starts)):
+        if(visited[first]):
+            continue
+        loop_edges = [first]
+        visited[first] = True
+        edge = next_edge[first]
+        while edge != first:
+            loop_edges.append(edge)
+            visited[edge] = True
+            edge = next_edge[edge]
+
+        #Only the vertices where the direction changes matter
+        loop_edges = np.array(loop_edges)
+        loop_directions = directions[loop_edges]
+        corners = starts[loop_edges[loop_directions != np.roll(loop_directions, 1)]]
+        x, y = corners[:, 0], corners[:, 1]
+        area = (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))/2
+        loops.append((corners, area))
+
+    return loops
+
+#Simplify a closed loop by splitting it in two at the point farthest from its start and simplifying each half
+def simplify_loop(corners, tolerance):
+    corners = corners.astype(float)
+    distances = np.hypot(corners[:, 0] - corners[0, 0], corners[:, 1] - corners[0, 1])
+    farthest = int(np.argmax(distances))
+    first_half = simplify_polyline(corners[:farthest+1], tolerance)
+    second_half = simplify_polyline(np.concatenate([corners[farthest:], corners[:1]]), tolerance)
+    return np.concatenate([first_half, second_half[1:-1]])
+
+#Turn a loop of padded pixel coordinates into a closed svg.path Path in potrace's SVG units
+def loop_to_path(points, frame_height):
+    complex_points = (points[:, 0] - 1)*SVG_UNITS_PER_PIXEL + (frame_height - (points[:, 1] - 1))*SVG_UNITS_PER_PIXEL*1j
+    path = Path(Move(complex_points[0]))
+    for start, end in zip(complex_points, np.roll(complex_points, -1)):
+        path.append(Line(start, end))
+    return path
+
+#In memory backend. Traces pixel boundaries (marching squares on the pixel corners) and simplifies each loop to within tolerance pixels
+def trace_contours(frame, t_size, tolerance):
+    paths = []
+    for corners, area in boundary_loops(frame):
+        if(abs(area) > t_size):
+            paths.append(loop_to_path(simplify_loop(corners, tolerance), frame.shape[0]))
+    return paths
+
+#Segments for one loop, the same as frame_segments would give for its loop_to_path but without making svg.path objects
+def loop_segments(points, frame_height):
+    complex_points = (points[:, 0] - 1)*SVG_UNITS_PER_PIXEL + (frame_height - (points[:, 1] - 1))*SVG_UNITS_PER_PIXEL*1j
+    controls = np.zeros((len(points) + 1, 4), dtype=complex)
+    controls[0, :2] = complex_points[0]
+    controls[1:, 0] = complex_points
+    controls[1:, 1] = np.roll(complex_points, -1)
+    kinds = np.full(len(points) + 1, LINE, dtype=np.int8)
+    kinds[0] = MOVE
+    return Segments(kinds, controls, np.abs(controls[:, 1] - controls[:, 0]))
+
+"""
+In memory backend that remembers the last frame it traced and only retraces what changed. Pixels that differ from the last
+frame mark their TILE_SIZE tiles as dirty. A loop only depends on the pixels around its vertices, so any loop from the last
+frame with no dirty tile under it is still a loop now and is reused along with its simplified segments and their lengths.
+Everything else is found by tracing just the rectangle around the dirty tiles and the loops they touch, keeping the loops
+that lie fully inside it (anything reaching its edge could be cut off) and touch a dirty tile. Loops are kept in the same
+order a full trace finds them in, so the result is identical to trace_contours, just quicker when little has changed.
+"""
+class ContourTracer:
+    def __init__(self, tolerance, tile_size=32, full_trace_fraction=0.5):
+        self.tolerance = tolerance
+        self.tile_size = tile_size
+        self.full_trace_fraction = full_trace_fraction     #Just retrace everything if the area to retrace is more than this much of the frame
+        self.frame = None
+        self.loops = []     #[order key, corners, area, segments (made when first needed)] for every loop in the last frame
+        self.rects = np.zeros((0, 4), dtype=np.int64)  #Pixels each loop depends on as (x0, y0, x1, y1), inclusive
+        self.reused = 0
+        self.retraced = 0
+
+    #Trace (part of) a frame, offsetting the loops by (x, y) to full frame coordinates
+    def find_loops(self, frame, x_offset=0, y_offset=0):
+        loops = []
+        for corners, area in boundary_loops(frame):
+            corners = corners + [x_offset, y_offset]
+            step = np.sign(corners[1] - corners[0])
+            direction = {(1, 0): 0, (0, 1): 1, (-1, 0): 2, (0, -1): 3}[(step[0], step[1])]
+            loops.append([(corners[0, 1], corners[0, 0], direction), corners, area, None])  #Full traces go in order of the first edge (y, x, direction)
+
+        #Corners are padded vertex coordinates and a vertex at v sits between pixels v-2 and v-1
+        rects = np.array([[corners[:, 0].min() - 2, corners[:, 1].min() - 2, corners[:, 0].max() - 1, corners[:, 1].max() - 1] for _, corners, _, _ in loops], dtype=np.int64).reshape(-1, 4)
+        return loops, rects
+
+    #Which rects have any dirty tile in them, using a summed area table of the dirty tiles
+    def touches(self, rects, dirty_table):
+        tiles = np.clip(rects//self.tile_size, 0, [dirty_table.shape[1] - 2, dirty_table.shape[0] - 2]*2)
+        x0, y0, x1, y1 = tiles[:, 0], tiles[:, 1], tiles[:, 2] + 1, tiles[:, 3] + 1
+        return (dirty_table[y1, x1] - dirty_table[y0, x1] - dirty_table[y1, x0] + dirty_table[y0, x0]) > 0
+
+    def update(self, frame):
+        if(self.frame is not None and frame.shape == self.frame.shape):
+            changed = frame != self.frame
+            if(not changed.any()):
+                self.reused, self.retraced = len(self.loops), 0
+                return
+
+            height, width = frame.shape
+            tile_rows, tile_columns = -(-height//self.tile_size), -(-width//self.tile_size)
+            padded = np.pad(changed, ((0, tile_rows*self.tile_size - height), (0, tile_columns*self.tile_size - width)))
+            dirty = padded.reshape(tile_rows, self.tile_size, tile_columns, self.tile_size).any(axis=(1, 3))
+            dirty_table = np.pad(dirty.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+            #Everything a new loop could depend on: the dirty tiles (plus a pixel, as vertices on their edge see past them) and the old loops touching them
+            invalid = self.touches(self.rects, dirty_table)
+            dirty_ys, dirty_xs = np.nonzero(dirty)
+            x0 = min(dirty_xs.min()*self.tile_size - 1, self.rects[invalid, 0].min(initial=width))
+            y0 = min(dirty_ys.min()*self.tile_size - 1, self.rects[invalid, 1].min(initial=height))
+            x1 = max((dirty_xs.max() + 1)*self.tile_size, self.rects[invalid, 2].max(initial=-1))
+            y1 = max((dirty_ys.max() + 1)*self.tile_size, self.rects[invalid, 3].max(initial=-1))
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width - 1), min(y1, height - 1)
+
+            if((x1 - x0 + 1)*(y1 - y0 + 1) <= self.full_trace_fraction*width*height):
+                #Loops reaching the edge of the region (where outside counts as light) could be cut off, unless that's the frame edge too
+                loops, rects = self.find_loops(frame[y0:y1+1, x0:x1+1], x0, y0)
+                inside = ((rects[:, 0] >= x0) | (x0 == 0)) & ((rects[:, 1] >= y0) | (y0 == 0)) & ((rects[:, 2] <= x1) | (x1 == width - 1)) & ((rects[:, 3] <= y1) | (y1 == height - 1))
+                new = inside & self.touches(rects, dirty_table)
+                kept = ~invalid
+
+                self.loops = [loop for loop, keep in zip(self.loops, kept) if keep] + [loop for loop, keep in zip(loops, new) if keep]
+                self.rects = np.concatenate([self.rects[kept], rects[new]])
+                order = sorted(range(len(self.loops)), key=lambda i: self.loops[i][0])
+                self.loops = [self.loops[i] for i in order]
+                self.rects = self.rects[order].reshape(-1, 4)
+                self.frame = frame
+                self.reused, self.retraced = int(np.sum(kept)), int(np.sum(new))
+                return
+
+        self.loops, self.rects = self.find_loops(frame)
+        self.frame = frame
+        self.reused, self.retraced = 0, len(self.loops)
+
+    #Segments for every loop with an area over t_size, same as frame_segments(trace_contours(frame, t_size, tolerance))
+    def trace(self, frame, t_size):
+        self.update(frame)
+        loop_parts = []
+        for loop in self.loops:
+            _, corners, area, segments = loop
+            if(abs(area) > t_size):
+                if(segments is None):
+                    segments = loop[3] = loop_segments(simplify_loop(corners, self.tolerance), frame.shape[0])
+                loop_parts.append(segments)
+
+        if(len(loop_parts) == 0):
+            return Segments(np.zeros(0, dtype=np.int8), np.zeros((0, 4), dtype=complex), np.zeros(0))
+        return Segments(*(np.concatenate(parts) for parts in zip(*loop_parts)))
@@ -1,8 +1,162 @@
-from PIL import Image
 import numpy as np
-import os, glob
-import math
-import wave
+import os, itertools
+from osc_frames import folder_frames, video_frames
+from osc_output import SampleFile, LiveStream, open_stream_target
+from osc_cache import FrameCache, frame_key, is_static
+
+from multiprocessing import Pool
+from collections import deque
+
+#Get the start+end cordinates of all run lengths of "True" colours for every column of a frame at once
+#Columns are read bottom to top and each run is stored as a row of (column, start, end) where end is exclusive.
+#Columns with no runs at all get a single (column, 0, 0) row so the beam just sits at 0 for them
+def extract_runs(pixel_array):
+    height, width = pixel_array.shape
+
+    #Flip so we read bottom to top, transpose so each row is a column and pad to deal with True values starting or ending it
+    padded = np.zeros((width, height+2), dtype=np.int8)
+    padded[:, 1:-1] = pixel_array[::-1, :].T
+
+    #Every non-zero difference is either a run start (0->1) or end (1->0), and as each padded column starts
+    #and ends with False they always come in pairs within the same column
+    edges = np.flatnonzero(np.diff(padded, axis=1))
+    columns, positions = np.divmod(edges, height+1)
+    runs = np.empty((len(edges)//2, 3), dtype=np.int64)
+    runs[:, 0] = columns[0::2]
+    runs[:, 1] = positions[0::2]
+    runs[:, 2] = positions[1::2]
+
+    #Sanity check for nulls (no run lengths at all in a column), add a [0,0] run for each
+    empty_columns = np.flatnonzero(np.bincount(runs[:, 0], minlength=width) == 0)
+    if(len(empty_columns) > 0):
+        empty_runs = np.zeros((len(empty_columns), 3), dtype=np.int64)
+        empty_runs[:, 0] = empty_columns
+        runs = np.concatenate([runs, empty_runs])
+        runs = runs[np.argsort(runs[:, 0], kind="stable")]
+
+    return runs
+
+#If a column doesn't have enough points to repeat each run at least twice then delete enough runs so it does (Smallest runs deleted first)
+def prune_runs(runs, width, column_points):
+    run_counts = np.bincount(runs[:, 0], minlength=width)
+    chunk_repeats = (column_points - run_counts - 1)//run_counts    #i.e. number of points allowed minus the #we use to transfer between runs / number of runs
+    over_budget_columns = np.flatnonzero(chunk_repeats < 2)
+    if(len(over_budget_columns) == 0):
+        return runs
+
+    print("Warning: low contrast from sample rate, dropping fine detail")
+
+    #Repeating k runs at least twice needs (column_points - k - 1)//k >= 2, i.e. 3k <= column_points - 1,
+    #so every over budget column gets cut down to the same number of runs (or just its longest one if even that's too many)
+    keep_count = max(1, (column_points - 1)//3)
+
+    #Lay each over budget column's runs out as a row and keep the keep_count longest in each. Keys are unique so equal lengths
+    #keep the later run (i.e. the earlier one is deleted first), and padding past the end of a column is -1 so it's never kept
+    column_counts = run_counts[over_budget_columns]
+    max_runs = column_counts.max()
+    slots = np.arange(max_runs)
+    positions = (np.cumsum(run_counts) - run_counts)[over_budget_columns][:, None] + slots
+    valid = slots < column_counts[:, None]
+    positions = np.where(valid, positions, 0)
+    keys = np.where(valid, (runs[positions, 2] - runs[positions, 1])*max_runs + slots, -1)
+    longest = np.argpartition(-keys, keep_count - 1, axis=1)[:, :keep_count]
+
+    keep = np.ones(len(runs), dtype=bool)
+    keep[positions[valid]] = False
+    keep[np.take_along_axis(positions, longest, axis=1)] = True
+    return runs[keep]
+
+"""
+Figure out how many times to repeat each run before going to the next, returning the repeats for every run and the leftover points
+each column then spends on its last run. Every column spends exactly column_points in total, which is floored so we'll under-use our
+point budget for the frame and need to pad it later for correct frame pacing. "uniform" gives every run in a column the same repeats,
+"proportional" shares the same total out by run length (at least 2 each where possible) so short runs don't look brighter than long ones
+"""
+def allocate_repeats(runs, width, column_points, mode="uniform"):
+    run_counts = np.bincount(runs[:, 0], minlength=width)
+    chunk_repeats = np.maximum((column_points - run_counts - 1)//run_counts, 0)  #i.e. number of points allowed minus the #we use to transfer between runs / number of runs
+    repeats = chunk_repeats[runs[:, 0]]
+
+    if(mode == "proportional"):
+        lengths = runs[:, 2] - runs[:, 1]
+        column_lengths = np.bincount(runs[:, 0], weights=lengths, minlength=width)
+        base_repeats = np.minimum(repeats, 2)
+        spare_repeats = (chunk_repeats - base_repeats[np.cumsum(run_counts) - 1])*run_counts
+        repeats = base_repeats + (spare_repeats[runs[:, 0]]*lengths//np.maximum(column_lengths[runs[:, 0]], 1)).astype(np.int64)
+    elif(mode != "uniform"):
+        raise ValueError(f"Unknown REPEAT_MODE: {mode}")
+
+    left_over_points = column_points - np.bincount(runs[:, 0], weights=repeats, minlength=width).astype(np.int64)
+    return repeats, left_over_points
+
+#Write the x/y samples for one frame's (already pruned) runs straight into frame_out, a preallocated (points, 2) block
+def emit_frame(runs, repeats, left_over_points, frame_out):
+    sample_points = len(frame_out)
+    width = len(left_over_points)
+    left_over_frame_points = sample_points - np.sum(repeats) - np.sum(left_over_points)    #Leftover points for the frame as a whole, spent on the last run of the last column
+
+    #Every run becomes a "segment" of its repeats, followed in each column by a segment on its last run for the leftover points
+    #and a final segment at the end of the frame. Sort them into drawing order with a (column, is leftover) key
+    last_runs = np.cumsum(np.bincount(runs[:, 0], minlength=width)) - 1
+    segment_runs = np.concatenate([np.arange(len(runs)), last_runs, [last_runs[-1]]])
+    segment_counts = np.concatenate([repeats, left_over_points, [left_over_frame_points]])
+    segment_keys = np.concatenate([runs[:, 0]*2, np.arange(width)*2 + 1, [width*2]])
+    order = np.argsort(segment_keys, kind="stable")
+    segment_runs = segment_runs[order]
+    segment_counts = segment_counts[order]
+
+    #j counts up from 0 within each segment, jumping y between the start and end of that run and x along the x_values pattern
+    sample_runs = np.repeat(segment_runs, segment_counts)
+    j = np.arange(sample_points) - np.repeat(np.cumsum(segment_counts) - segment_counts, segment_counts)
+    frame_out[:, 0] = runs[sample_runs, 0] + x_pattern[j % x_values_len]
+    frame_out[:, 1] = runs[sample_runs, 1 + j%2]
+
+#Runs for a frame given the last frame (same size) and its runs from extract_runs, only extracting the columns that changed
+def update_runs(pixel_array, previous_array, previous_runs):
+    changed = np.any(pixel_array != previous_array, axis=0)
+    if(not changed.any()):
+        return previous_runs
+
+    #Each column's runs all come from one frame or the other so a stable sort by column keeps them in order
+    changed_columns = np.flatnonzero(changed)
+    new_runs = extract_runs(pixel_array[:, changed_columns])
+    new_runs[:, 0] = changed_columns[new_runs[:, 0]]
+    runs = np.concatenate([previous_runs[~changed[previous_runs[:, 0]]], new_runs])
+    return runs[np.argsort(runs[:, 0], kind="stable")]
+
+#Convert one frame (2D boolean array, True = white) into its SAMPLE_POINTS x/y samples, written straight into frame_out
+#Its runs can be given if they're already known (e.g. from update_runs), otherwise they're extracted here
+def convert_frame(pixel_array_cols, frame_out, runs=None):
+    width = pixel_array_cols.shape[1]
+    COLUMN_POINTS = SAMPLE_POINTS//width    #May change between images so might as well check each frame
+
+    #Get the start+end cordinates of all run lengths of "True" colours and drop the smallest ones from any columns over budget
+    if(runs is None):
+        runs = extract_runs(pixel_array_cols)
+    runs = prune_runs(runs, width, COLUMN_POINTS)
+
+    #Now add each column's respective points
+    repeats, left_over_points = allocate_repeats(runs, width, COLUMN_POINTS, REPEAT_MODE)
+    emit_frame(runs, repeats, left_over_points, frame_out)
+
+"""
+Wrapper for the worker processes. Frames come in as (shape, np.packbits bytes) pairs and the whole chunk's samples go back as
+raw int16 bytes, so nothing bigger than it needs to be is pickled between processes. The chunk's frames are consecutive so
+each one after the first only has runs extracted for the columns that changed since the one before
+"""
+def convert_frame_chunk(packed_chunk):
+    chunk_points = np.empty((len(packed_chunk)*SAMPLE_POINTS, 2), dtype=np.int16)
+    previous_array = previous_runs = None
+    for i, (shape, packed_frame) in enumerate(packed_chunk):
+        pixel_array_cols = np.unpackbits(np.frombuffer(packed_frame, dtype=np.uint8), count=shape[0]*shape[1]).reshape(shape).astype(bool)
+        if(previous_array is not None and previous_array.shape == pixel_array_cols.shape):
+            runs = update_runs(pixel_array_cols, previous_array, previous_runs)
+        else:
+            runs = extract_runs(pixel_array_cols)
+
+        convert_frame(pixel_array_cols, chunk_points[i*SAMPLE_POINTS:(i+1)*SAMPLE_POINTS], runs)
+        previous_array, previous_runs = pixel_array_cols, runs
+    return chunk_points.tobytes()
 
 ########USER VARIABLES START########
 
@@ -18,150 +172,129 @@ FPS = 15    #Higher fps will be more fluid but require more samples per frame
 
 x_values = [0]  #Vertical line producing "sharp" looking picture. [0,0,1,1] instead would give maximum width using a bow shape
 
+#How each column's points are shared between its runs. "uniform" repeats every run the same number of times, "proportional" gives
+#longer runs more repeats for a more even brightness (short runs otherwise look brighter) at the cost of some faux detail
+REPEAT_MODE = "uniform"
+
+#Frames are read from the numbered 1-bit PNGs in input_pngs by default. Alternatively set VIDEO_PATH to have ffmpeg decode the video
+#directly into memory instead (no intermediate files), scaled to Y_RESOLUTION and thresholded so anything brighter than THRESHOLD is white
+VIDEO_PATH = None       #e.g. "VIDEO.mp4"
+Y_RESOLUTION = 80       #None keeps the source resolution
+THRESHOLD = 128         #0-255
+
+#Finished frames are cached by their content so repeated/held frames are only converted once. Setting CACHE_FOLDER (e.g. "frame_cache")
+#also keeps them on disk between runs, so re-rendering with the same SAMPLE_RATE/FPS/x_values is almost free
+CACHE_MEMORY_MB = 256   #How much RAM to keep cached frames in
+CACHE_FOLDER = None     #Folder to keep cached frames in between runs, None to only cache in memory
+CACHE_DISK_MB = 2048    #How much disk space the cache folder can use before the oldest frames are deleted
+STATIC_FRAME_PIXELS = 0 #Frames with at most this many pixels different from the last converted frame just reuse its samples (0 = only exact repeats)
+
+PROCESS_COUNT = os.cpu_count()  #How many processes to convert frames with. More = faster, up to how quickly frames can be read in
+CHUNK_FRAMES = 16       #How many consecutive frames to hand a process at once. Larger means less overhead but more memory use
+
+#What to write the output to. A .wav by default, or any other extension for a raw file of just the interleaved little endian samples
+#(e.g. "rast_osc_output.f32"), which also isn't limited to 4GB like a .wav is
+OUTPUT_FILE = "rast_osc_output.wav"
+SAMPLE_FORMAT = "s16"   #"s16", "s24" or "f32" (float32). 24 bit or float keeps finer positioning than 16 bit, worth it at large resolutions/sample rates
+
+#Instead of writing a .wav, stream each frame's raw samples (interleaved little endian 16 bit stereo at SAMPLE_RATE) live as it's
+#converted, e.g. "-" for stdout then pipe into something like: aplay -f S16_LE -c 2 -r SAMPLE_RATE. Frames that aren't ready in time
+#repeat the previous one, and underruns + latency are reported at the end so you can tell if your settings keep up in real time
+STREAM_OUTPUT = None    #None writes the .wav, "-" streams to stdout, anything else is a file/named pipe path to stream to
+STREAM_LOOKAHEAD = 8    #How many finished frames to buffer before starting the stream's clock. More rides out slow frames but adds latency
+
 ########USER VARIABLES END########
 
-#Get a list of all the PNGs to convert and set any constants
+#Set some constants
 CWD = os.getcwd()
 x_values_len = len(x_values)
+x_pattern = np.array(x_values)
+SAMPLE_POINTS = int(SAMPLE_RATE/FPS)
 png_folder = os.path.join(CWD, "input_pngs")
-png_files = []
-
-os.chdir(png_folder)
-for file in glob.glob("*.png"):
-    png_files.append(file)
-    
-#Sort them numerically
-png_files.sort(key=lambda x: int(x.split('.')[0]))
-
-x_bytes = []
-y_bytes = []
-
-for png in png_files:
-    print("Currently on file:", png)
-    
-    #Load the original image. Note we're expecting 1 bit so either True or False for colour
-    with open(png,"rb") as fin:
-        img = Image.open(fin)
-        width, height = img.size
-        pixel_array_cols = np.asarray(img)
-
-    #May change between images so might as well check each frame
-    SAMPLE_POINTS = int(SAMPLE_RATE/FPS)
-    COLUMN_POINTS = SAMPLE_POINTS/width
-    
-    #Get the start+end cordinates of all run lengths of "True" colours
-    run_lengths = []
-    for i in range(0, width):
-        current_column = np.flip(pixel_array_cols[:, i])    #Read bottom to top of column
-        col_lengths = []
-
-        #Pad it to deal with True values starting or ending it
-        current_column = np.concatenate([[False], current_column, [False]])
-
-        count = 0   #To keep track of what run group we're on independently of j beneath
-        current_run_group = []
-        for j in range(1, height+2):    #Offsets in range are to account for the padding/prev_value
-            cur_value = current_column[j]
-            prev_value = current_column[j-1]
-
-            if(cur_value != prev_value):
-                current_run_group.append(j-1)
-                count+=1
-
-                #Add them in groups of 2
-                if(count%2 == 0):
-                    col_lengths.append(current_run_group)
-                    current_run_group = []
-
-        #Sanity check for nulls (no run lengths at all in this column)
-        #Just set beam to 0,0 for this run if so
-        if(len(col_lengths) == 0):
-            col_lengths.append([0,0])
-            
-        run_lengths.append(col_lengths)
-
-    #Now for each column add its respective points
-    for i, column_runs in enumerate(run_lengths):
-        #Figure out how many times to repeat each run before going to the next
-        #Note both are floored so we'll under-use our point budget for both columns, and frames and need to pad them later for correct frame pacing
-        chunk_repeats = math.floor(( math.floor(COLUMN_POINTS) - len(column_runs)-1 )/len(column_runs))   #i.e. number of points allowed minus the #we use to transfer between runs / number of runs
-        left_over_points = math.floor(COLUMN_POINTS) - chunk_repeats*len(column_runs)   #Leftover points to use for the last run in this column
-
-        #If we don't have enough points to repeat at least twice then delete enough runs so we do (Smallest runs deleted first)
-        if(chunk_repeats < 2):
-            print("Warning: low contrast from sample rate, dropping fine detail")
-            #DEBUG: print("Length prior:", len(column_runs), chunk_repeats, column_runs)
-
-            #Find max runs allowed emperically (No clue how floor functions can be algebraically manipulated)
-            for k in range(len(column_runs), 0, -1):
-                chunk_repeats = math.floor(( math.floor(COLUMN_POINTS) - k-1 )/k)
-                if(chunk_repeats >= 2):
+
+#Only run this section if it's the main script running, not a sub-process from multiprocessing
+if __name__ == '__main__':
+    #Opened first so when streaming to stdout everything printed from here on (here and in the workers) goes to stderr instead
+    stream_file = None if STREAM_OUTPUT is None else open_stream_target(STREAM_OUTPUT)
+
+    if(VIDEO_PATH is None):
+        frames = folder_frames(png_folder, "png", THRESHOLD)
+    else:
+        frames = video_frames(VIDEO_PATH, FPS, Y_RESOLUTION, THRESHOLD)
+
+    #Each frame is written to the .wav as soon as it's done so scale everything by the largest x/y the first frame can use
+    first_frame = next(frames)
+    first_height, first_width = first_frame.shape
+    frames = itertools.chain([first_frame], frames)
+
+    """
+    Hand out batches of CHUNK_FRAMES consecutive frames to the worker processes and write each one to the .wav in order as soon
+    as it's (and everything before it is) finished. Cached frames and repeats of frames still being converted are filled in here
+    without being sent off at all, and only a couple of batches per process are ever queued up so memory use doesn't grow with the video
+    """
+    numbered_frames = enumerate(frames, 1)
+    pending = deque()
+    cache = FrameCache(CACHE_MEMORY_MB*2**20, CACHE_FOLDER, CACHE_DISK_MB*2**20)
+    in_flight = {}  #Key of each frame still being converted to a one item list that's filled in with its samples once written
+    CACHE_SETTINGS = ("raster", SAMPLE_POINTS, tuple(x_values), REPEAT_MODE)
+    static_reference = None
+    static_key = None   #Key of static_reference, which frames close enough to it share
+    reused_frames = 0
+    frames_left = True
+
+    if(stream_file is None):
+        output = SampleFile(os.path.join(CWD, OUTPUT_FILE), SAMPLE_RATE, first_width - 1 + max(x_values), first_height, SAMPLE_FORMAT)
+    else:
+        output = LiveStream(stream_file, FPS, first_width - 1 + max(x_values), first_height, STREAM_LOOKAHEAD)
+
+    with Pool(PROCESS_COUNT) as p, output:
+        while frames_left or len(pending) > 0:
+            packed_chunk = []
+            chunk_keys = []
+            plan = []   #For each frame in order either its finished samples or its in_flight slot
+            while frames_left and len(plan) < CHUNK_FRAMES:
+                numbered_frame = next(numbered_frames, None)
+                if(numbered_frame is None):
+                    frames_left = False
                     break
 
-            #k now has how many we need to get down to so
-            num_to_delete = len(column_runs) - k
-            
-            #Now find the length of each run to get the shortest:
-            lengths = []
-            for k, run in enumerate(column_runs):
-                lengths.append([run[1] - run[0], k])
-                
-            lengths.sort()  #Sortest so smallest run is first stored with it's index in [1]
-            
-            indicies_to_delete = []
-            for k in range(num_to_delete):
-                indicies_to_delete.append(lengths[k][1])
-
-            indicies_to_delete.sort(reverse = True)
-            for index in indicies_to_delete:
-                del column_runs[index]
-                  
-            #DEBUG: print("Length post trim:", len(column_runs), chunk_repeats, column_runs)
-            
-            #We've changed these values so calculate again
-            chunk_repeats = math.floor(( math.floor(COLUMN_POINTS) - len(column_runs)-1 )/len(column_runs))
-            left_over_points = math.floor(COLUMN_POINTS) - chunk_repeats*len(column_runs)
-            
-        #Now go through each specific run and add it's points
-        for run_points in column_runs:
-            for j in range(chunk_repeats):  #Jump y between the start and end of this run_point chunk
-                y_bytes.append(run_points[j%2])
-                x_bytes.append(i + x_values[j%x_values_len])   #Append the current column x value plus whatever modifying array we defined earlier to alter the path + increase effective width
-
-        #Now add any leftover points we have for this column run by repeating the last run enough times
-        for j in range(left_over_points):
-            y_bytes.append(column_runs[-1][j%2])
-            x_bytes.append(i + x_values[j%x_values_len])
-
-    #Now here we still need to account for the leftover points for the frame as a whole as we took the floor of the COLUMN POINTS
-    #Do this the same way as above but for the last column of the frame
-    left_over_frame_points = SAMPLE_POINTS - math.floor(SAMPLE_POINTS/width) * width
-    for i in range(left_over_frame_points):
-        y_bytes.append(run_lengths[-1][-1][i%2])
-        x_bytes.append((width-1) + x_values[i%x_values_len])
-
-
-#Scale, format and write the final audio files
-x_16 = np.array(x_bytes, dtype=np.int16)
-y_16 = np.array(y_bytes, dtype=np.int16)
-
-##Scale our amplitudes
-x_16 = np.multiply(x_16, 65534/np.max(x_16))    #Slightly under 2^16 to account for lower signed + range and any rounding errors
-y_16 = np.multiply(y_16, 65534/np.max(y_16))
-
-#Center them around 0
-x_max = np.max(x_16)
-y_max = np.max(y_16)
-x_16 = np.subtract(x_16, x_max/2)
-y_16 = np.subtract(y_16, y_max/2)
-
-stereo_amplitudes = np.array([x_16, y_16]).T.astype("<h")
-
-os.chdir(CWD) #Set current dir to save
-with wave.open("rast_osc_output.wav", "w") as f:
-    f.setnchannels(2)
-    f.setsampwidth(2)   #16 bit = 2 bytes
-    f.setframerate(SAMPLE_RATE)
-    f.writeframes(stereo_amplitudes.tobytes())
-
-print("Finished overall, file written")
+                frame_number, pixel_array_cols = numbered_frame
+                print("Currently on frame:", frame_number)
+
+                #Frames close enough to the last one we converted count as the same frame, otherwise look it up by its own content
+                if(not is_static(pixel_array_cols, static_reference, STATIC_FRAME_PIXELS)):
+                    static_reference = pixel_array_cols
+                    static_key = frame_key(pixel_array_cols, CACHE_SETTINGS)
+                key = static_key
+
+                cached_frame = cache.get(key)
+                if(cached_frame is not None):
+                    plan.append(cached_frame)
+                elif(key in in_flight):
+                    plan.append(in_flight[key])
+                else:
+                    in_flight[key] = [None]
+                    plan.append(in_flight[key])
+                    packed_chunk.append((pixel_array_cols.shape, np.packbits(pixel_array_cols).tobytes()))
+                    chunk_keys.append(key)
+
+            if(len(plan) > 0):
+                result = None
+                if(len(packed_chunk) > 0):
+                    result = p.apply_async(convert_frame_chunk, (packed_chunk,))
+                pending.append((result, chunk_keys, plan))
+                reused_frames += len(plan) - len(packed_chunk)
+
+            #Write out the oldest batch once the queue is full, or everything left once we're out of frames
+            if(len(pending) > 0 and (len(pending) >= PROCESS_COUNT*2 or not frames_left)):
+                result, chunk_keys, plan = pending.popleft()
+                if(result is not None):
+                    chunk_points = np.frombuffer(result.get(), dtype=np.int16).reshape(-1, SAMPLE_POINTS, 2)
+                    for key, frame_points in zip(chunk_keys, chunk_points):
+                        in_flight.pop(key)[0] = frame_points
+                        cache.put(key, frame_points.copy())  #Its own bytes rather than a view keeping the whole batch alive
+
+                for entry in plan:
+                    output.write(entry[0] if isinstance(entry, list) else entry)
+
+    print(f"Finished overall, {'file written' if stream_file is None else 'stream closed'} ({reused_frames} frames reused rather than converted)")
@@ -1,99 +1,84 @@
-import glob, os, pathlib, subprocess    #File management + CMD
-from svg.path import parse_path
-from svg.path.path import Line
-from xml.dom import minidom
+import os, itertools, time    #File management + timing
 import numpy as np
 import logging
-import wave
+from osc_frames import folder_frames, video_frames
+from osc_output import SampleFile, LiveStream, open_stream_target
+from osc_trace import SVG_UNITS_PER_PIXEL, find_potrace, trace_potrace, trace_contours, ContourTracer
+from osc_segments import frame_segments, count_points, sample_segments
+from osc_order import order_segments
+from osc_cache import FrameCache, frame_key, is_static
+from osc_metrics import MetricsLog
 
 from multiprocessing import Pool
+from collections import deque
 import threading
 
-#Used for silencing CMD window on Windows
-startupinfo = None
-if os.name == 'nt':
-    startupinfo = subprocess.STARTUPINFO()
-    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-#From stackoverflow https://stackoverflow.com/questions/69313876/how-to-get-points-of-the-svg-paths
-def get_point_at(path, distance, scale, offset):
-    pos = path.point(distance)
-    pos += offset
-    pos *= scale
-    return pos.real, pos.imag
-
-def points_from_path(path, density, scale, offset):
-    step = int(path.length() * density)
-    last_step = step - 1
-
-    #If it's < 0 then it's too small to worry about for this density
-    #saves quite a few points to spend on higher density instead
-    if last_step == 0:
-        yield get_point_at(path, 0, scale, offset)
-        return
-
-    for distance in range(step):
-        yield get_point_at(
-            path, distance / last_step, scale, offset)
-
-def points_from_doc(doc, density=5, scale=1, offset=0):
-    offset = offset[0] + offset[1] * 1j
-    points = []
-    for element in doc.getElementsByTagName("path"):
-        for path in parse_path(element.getAttribute("d")):
-            points.extend(points_from_path(
-                path, density, scale, offset))
-            
-    return points
-
-#Call POTRACE to convert the given BMP to SVG with provided settings and return the path of the resultant file
-#Thank God for fstrings
-def bmp_to_SVG(bmp_path, a, t_size):
-    output_path = os.path.join(CWD, "output_svgs", pathlib.Path(bmp_path).stem + ".svg")  #CWD + svg_folder + filename
-    subprocess.run(f'cmd /c ""{POTRACE_PATH}" "{bmp_path}" -b svg -t {t_size} -a {a} -O {OPT_TOLERANCE} -o "{output_path}""', startupinfo=startupinfo)
-    return output_path
+#Trace the given frame with whichever TRACER backend is chosen, returning its outlines as a list of svg.path Paths
+def trace_frame(frame, t_size):
+    if(TRACER == "potrace"):
+        return trace_potrace(frame, t_size, A_QUALITY, OPT_TOLERANCE, POTRACE_PATH)
+    elif(TRACER == "contour"):
+        return trace_contours(frame, t_size, CONTOUR_TOLERANCE)
+    raise ValueError(f"Unknown TRACER: {TRACER}")
 
 """
-Converts given bmp to a list of x/y samples representing it in the best quality possible and returns the bounds used.
+Converts given frame (a 2D boolean array, True = white) to a list of x/y samples representing it in the best quality possible and returns the bounds used.
 This is done starting with the inital T_QUALITY, doing a binary convergence on a density value that gets as close to the
 sample point budget as required, and only increasing the T_QUALITY_INPUT if that isn't possible continuously till a conversion
 is possible. An array of the x/y points is returned as well as the bounds used for the density so they can be used as a first
-guess for the next frame processed
+guess for the next frame processed, and a dict of metrics on how long each stage took and how the search went.
+If a ContourTracer is given it's used instead of trace_frame, so only the parts that changed since its last frame are retraced
 """
-def process_bmp(bmp_name, A_QUALITY, T_QUALITY_INPUT, density_upper_limit, density_lower_limit):
+def process_bmp(frame, frame_name, T_QUALITY_INPUT, density_upper_limit, density_lower_limit, contour_tracer=None):
+    metrics = {"frame": frame_name, "trace_seconds": 0.0, "parse_seconds": 0.0, "search_seconds": 0.0, "order_seconds": 0.0, "resample_seconds": 0.0,
+               "search_iterations": 0, "limit_rescales": 0, "t_escalations": 0, "travel_saved": None, "loops_reused": None}
+    start_time = time.perf_counter()
+
     #We keep increasing the -t size until it's low enough detail to fit into our SAMPLE_POINTS limitation.
     #(T_QUALITY should be set such that this case is rare anyway)
     while True:
-        svg_path = bmp_to_SVG(bmp_name, A_QUALITY, T_QUALITY_INPUT)  #First convert to a SVG using the current t_size
-        doc = minidom.parse(svg_path)
+        stage_time = time.perf_counter()
+        if(contour_tracer is not None):
+            segments = contour_tracer.trace(frame, T_QUALITY_INPUT)  #Unchanged loops come with their segments already measured
+            metrics["trace_seconds"] += time.perf_counter() - stage_time
+            metrics["loops_reused"] = contour_tracer.reused
+        else:
+            doc = trace_frame(frame, T_QUALITY_INPUT)  #First trace it using the current t_size
+            metrics["trace_seconds"] += time.perf_counter() - stage_time
+            stage_time = time.perf_counter()
+            segments = frame_segments(doc)  #Measures every segment once so we don't have to keep resampling it to see how many points a density gives
+            metrics["parse_seconds"] += time.perf_counter() - stage_time
+        lengths = segments.lengths
+        stage_time = time.perf_counter()
 
         #If this isn't the first frame then we need to check the old limits from last frame are still valid
         #(This is still quicker and general than imposing fixed inital limits like above for all frames)
         #Upper + null check
         while True:
-            points = points_from_doc(doc, density=density_upper_limit, scale=1, offset=(0,0))   #Check upper limit
-            upper_limit_points = len(points)
+            upper_limit_points = count_points(lengths, density_upper_limit)   #Check upper limit
 
             #Sanity check for SVGs with 0 points, if so just return array pointing at 0's for all points
             if(upper_limit_points == 0):
-                x_bytes = [0]*SAMPLE_POINTS
-                y_bytes = x_bytes
+                frame_points = np.zeros((SAMPLE_POINTS, 2), dtype=np.float32)
                 density_upper_limit = 1
                 density_lower_limit = DENSITY_ABSOLUTE_LOWER_LIMIT
-                return x_bytes, y_bytes, density_upper_limit, density_lower_limit
+                metrics["search_seconds"] += time.perf_counter() - stage_time
+                metrics.update(t_size=T_QUALITY_INPUT, density=None, points=0, sample_points=SAMPLE_POINTS, seconds=time.perf_counter() - start_time)
+                return frame_points, density_upper_limit, density_lower_limit, metrics
                             
             if(upper_limit_points < SAMPLE_POINTS):
                 density_upper_limit*=2  #Increase inital range for binary search
-                logger.error(f"Rescaling upper limit {svg_path} points {upper_limit_points}")  
+                metrics["limit_rescales"] += 1
+                logger.error(f"Rescaling upper limit frame {frame_name} points {upper_limit_points}")  
             else:
                 break
             
         #Lower check
         while True:
-            points = points_from_doc(doc, density=density_lower_limit, scale=1, offset=(0,0))   #Check lower limit
-            lower_limit_points = len(points)
+            lower_limit_points = count_points(lengths, density_lower_limit)   #Check lower limit
             if(lower_limit_points > SAMPLE_POINTS):
                 density_lower_limit*=0.5  #Increase inital range for binary search (by lowering the lower limit here)
+                metrics["limit_rescales"] += 1
                 logger.error("Rescaling lower limit")  
             else:
                 break
@@ -102,7 +87,8 @@ def process_bmp(bmp_name, A_QUALITY, T_QUALITY_INPUT, density_upper_limit, densi
         if(density_lower_limit < DENSITY_ABSOLUTE_LOWER_LIMIT):  #If we need to scale the lower limit this far then skip everything, increase t_size and try again
             T_QUALITY_INPUT *= 1.5    #Arbitrarily chosen increase
             density_lower_limit = DENSITY_ABSOLUTE_LOWER_LIMIT
-            doc.unlink()    #Unlink old current doc
+            metrics["t_escalations"] += 1
+            metrics["search_seconds"] += time.perf_counter() - stage_time
             logger.error("Too complex, adjusting t_size for current frame")
             continue
         
@@ -114,9 +100,9 @@ def process_bmp(bmp_name, A_QUALITY, T_QUALITY_INPUT, density_upper_limit, densi
         while (abs(SAMPLE_POINTS - current_points) > THRESHOLD_LIMIT) and (current_points != prev_points) :    #While we haven't reached the threshold and cur!=prev (covers edge cases where there's discontinutiy + it won't converge)      
 
             density_midpoint = (density_upper_limit+density_lower_limit)/2
-            points = points_from_doc(doc, density=density_midpoint, scale=1, offset=(0,0))
             prev_points = current_points
-            current_points = len(points)
+            current_points = count_points(lengths, density_midpoint)
+            metrics["search_iterations"] += 1
             
             logger.warning(f"Current points: {current_points}")
 
@@ -126,49 +112,65 @@ def process_bmp(bmp_name, A_QUALITY, T_QUALITY_INPUT, density_upper_limit, densi
             elif(current_points < SAMPLE_POINTS):  #Midpoint is too high (Too few points)
                 density_lower_limit = density_midpoint
 
+        metrics["search_seconds"] += time.perf_counter() - stage_time
         break   #If we've gotten here then t_size is correct and we're close to the SAMPLE_POINTS so no need to loop
 
-    #At this point we're as close to the goal as possible for this frame so unlink and set the limits for the next frame
-    doc.unlink()
+    #At this point we're as close to the goal as possible for this frame so set the limits for the next frame
     logger.error(f"Final upper + lower limits are: {density_upper_limit}, {density_lower_limit}")
 
+    #Draw the subpaths in an order that keeps the beam's jumps between them short (doesn't change how many points there are)
+    if(ORDER_PATHS):
+        stage_time = time.perf_counter()
+        segments, travel_before, travel_after = order_segments(segments, ORDER_PASSES)
+        metrics["order_seconds"] = time.perf_counter() - stage_time
+        metrics["travel_saved"] = (travel_before - travel_after)/SVG_UNITS_PER_PIXEL
+        logger.warning(f"Path ordering cut travel from {travel_before/SVG_UNITS_PER_PIXEL:.0f} to {travel_after/SVG_UNITS_PER_PIXEL:.0f} pixels")
+
+    #Only now actually generate the points, once, at the density we settled on
+    stage_time = time.perf_counter()
+    points = sample_segments(segments, density_midpoint)
+    metrics["resample_seconds"] = time.perf_counter() - stage_time
+
     #Assuming frame-frame variance is likely to be about 20% we can use these as a best firt guess for the next frame for faster convergence
     density_upper_limit *= 1.2
     density_lower_limit *= 0.8
     
-    #Make sure we've got exactly SAMPLE_POINTS, could be a bit over/under and add them
-    x_bytes = []
-    y_bytes = []
-    for point in points:
-        x_bytes.append(point[0])
-        y_bytes.append(point[1])
-
-    difference = abs(SAMPLE_POINTS - len(x_bytes))
-    if(len(x_bytes) < SAMPLE_POINTS):
-        x_bytes += [x_bytes[-1]]*difference
-        y_bytes += [y_bytes[-1]]*difference
-    elif(len(x_bytes) > SAMPLE_POINTS):
-        x_bytes = x_bytes[0:len(x_bytes) - difference]
-        y_bytes = y_bytes[0:len(y_bytes) - difference]
-
-    return x_bytes, y_bytes, density_upper_limit, density_lower_limit
-
-#Wrapper for the actual bmp conversion for threads, handles each separately
-def thread_wrapped_bmp_convert(bmp_files):
-    #Keep track of these outside of the function so we can carry limits from the previous frame in the next frame
-    os.chdir(bmp_folder)    #Make sure we're in the BMP directory
-    density_upper_limit = 1  #Very large first guess (so we don't undershoot) but will optimise based on earlier frames later on
-    density_lower_limit = DENSITY_ABSOLUTE_LOWER_LIMIT  #We don't want to go beneath this though, if we do then drop -t value instead
-    
-    chunk_x_bytes = []
-    chunk_y_bytes = []
-    for file in bmp_files:
-        logger.critical(f"Processing file: {file}")   
-        frame_x_bytes, frame_y_bytes, density_upper_limit, density_lower_limit = process_bmp(file, A_QUALITY, T_QUALITY, density_upper_limit, density_lower_limit)
-        chunk_x_bytes += frame_x_bytes
-        chunk_y_bytes += frame_y_bytes
+    #Make sure we've got exactly SAMPLE_POINTS, could be a bit over/under so either repeat the last point or cut the end off
+    #Kept as float32 rather than rounded to whole SVG units so none of the sub-pixel detail is lost before scaling
+    frame_points = np.zeros((SAMPLE_POINTS, 2), dtype=np.float32)
+    used_points = min(len(points), SAMPLE_POINTS)
+    if(used_points > 0):
+        frame_points[:used_points] = points[:used_points]
+        frame_points[used_points:] = points[used_points-1]
+
+    metrics.update(t_size=T_QUALITY_INPUT, density=density_midpoint, points=len(points), sample_points=SAMPLE_POINTS, seconds=time.perf_counter() - start_time)
+    return frame_points, density_upper_limit, density_lower_limit, metrics
 
-    return [chunk_x_bytes, chunk_y_bytes]
+"""
+Wrapper for the actual bmp conversion for threads, handles each (frame number, frame) pair in the chunk separately carrying
+the density limits from each frame on to the next. The chunk is made of whole groups of WARM_START_FRAMES frames and the
+limits start from scratch at the start of each group, so a frame's samples don't depend on how the frames were split up into
+batches. With the contour tracer each frame after the first in the chunk only retraces what changed from the one before.
+Returns all of the chunk's samples as one float32 array, how long it took and each frame's metrics
+"""
+def thread_wrapped_bmp_convert(frame_chunk):
+    start_time = time.perf_counter()
+    contour_tracer = None
+    if(TRACER == "contour" and INCREMENTAL_TILE_SIZE > 0):
+        contour_tracer = ContourTracer(CONTOUR_TOLERANCE, INCREMENTAL_TILE_SIZE)
+
+    chunk_points = np.empty((len(frame_chunk)*SAMPLE_POINTS, 2), dtype=np.float32)
+    chunk_metrics = []
+    for i, (frame_number, frame) in enumerate(frame_chunk):
+        logger.critical(f"Processing frame: {frame_number}")   
+        if(i == 0 or (frame_number - 1)//WARM_START_FRAMES != (frame_chunk[i-1][0] - 1)//WARM_START_FRAMES):
+            density_upper_limit = 1  #Very large first guess (so we don't undershoot) but will optimise based on earlier frames later on
+            density_lower_limit = DENSITY_ABSOLUTE_LOWER_LIMIT  #We don't want to go beneath this though, if we do then drop -t value instead
+        frame_points, density_upper_limit, density_lower_limit, metrics = process_bmp(frame, frame_number, T_QUALITY, density_upper_limit, density_lower_limit, contour_tracer)
+        chunk_points[i*SAMPLE_POINTS:(i+1)*SAMPLE_POINTS] = frame_points
+        chunk_metrics.append(metrics)
+
+    return chunk_points, time.perf_counter() - start_time, chunk_metrics
 
 
 
@@ -177,13 +179,49 @@ def thread_wrapped_bmp_convert(bmp_files):
 
 SAMPLE_RATE = 96000                 #A higher sample rate means effective higher "resolution" images and gives a higher point budget
 FPS = 15                            #Match FPS with the source. Make sure to chose a sample_rate/fps combo such that sample_rate%fps == 0 for correct pacing
+TRACER = "potrace"                  #"potrace" to use the potrace program, or "contour" to trace in memory without it (quicker but only straight lines, no curve fitting)
 A_QUALITY = 0.1                     #Smaller means more jagged SVG output but fewer points {0 < x < 1.333}
 T_QUALITY = 50                      #Details smaller than this will be muted (in pixels) by default. Larger value uses less points but ignores small details
 THRESHOLD_LIMIT = 10                #How close do we want each frame to be to the point limit? Smaller is better but even values of 100 should be fine and larger will be quicker
 DENSITY_ABSOLUTE_LOWER_LIMIT = 0.01 #What's the min density we'll tolerate before just dropping -t (T_QUALITY)? Higher means a better quality floor but uses more points
 THREAD_COUNT = 7                    #How many threads to use? More = faster
 OPT_TOLERANCE = 0.2                 #Larger values try to reduce number of curve segments, losing detail but using less points {0<x<inf}
+ORDER_PATHS = True                  #Reorder/reverse each frame's outlines so the beam jumps between them as little as possible, giving fewer retrace lines
+ORDER_PASSES = 8                    #Most 2-opt improvement passes over the order per frame. More can shorten the jumps further on busy frames but is slower
+CONTOUR_TOLERANCE = 1.0             #"contour" tracer only. How far (in pixels) a simplified outline can stray from the pixel edges. Larger is smoother and uses less points
+INCREMENTAL_TILE_SIZE = 32          #"contour" tracer only. Consecutive frames only retrace tiles of this many pixels that changed, reusing the rest. 0 always traces whole frames
 LOG_LEVEL = logging.ERROR           #How much output info do we want? CRITICAL > ERROR > WARNING (Inverse to expected, don't worry if "WARNING/ERRORS" appear, they're just debug)
+CHUNK_SECONDS = 2                   #Roughly how long each batch of consecutive frames handed to a thread should take. Longer means less overhead but coarser load balancing
+MAX_CHUNK_FRAMES = 30               #Most frames to hand a thread at once no matter how quick they are, to keep memory use down
+WARM_START_FRAMES = 8               #Each frame's density search starts from the last one's result within groups of this many frames. Batches are made of whole groups so the output is the same however they're split up
+
+#Frames are read from the numbered BMPs in input_bmps by default. Alternatively set VIDEO_PATH to have ffmpeg decode the video
+#directly into memory instead (no intermediate files), scaled to Y_RESOLUTION and thresholded so anything brighter than THRESHOLD is white
+VIDEO_PATH = None                   #e.g. "VIDEO.mp4"
+Y_RESOLUTION = 360                  #None keeps the source resolution
+THRESHOLD = 128                     #0-255
+
+#Finished frames are cached by their content so repeated/held frames are only converted once. Setting CACHE_FOLDER (e.g. "frame_cache")
+#also keeps them on disk between runs, so re-rendering after changing unrelated settings is almost free
+CACHE_MEMORY_MB = 256               #How much RAM to keep cached frames in
+CACHE_FOLDER = None                 #Folder to keep cached frames in between runs, None to only cache in memory
+CACHE_DISK_MB = 2048                #How much disk space the cache folder can use before the oldest frames are deleted
+STATIC_FRAME_PIXELS = 0             #Frames with at most this many pixels different from the last converted frame just reuse its samples (0 = only exact repeats)
+
+#Timings and search stats for every converted frame, useful for tuning THRESHOLD_LIMIT, DENSITY_ABSOLUTE_LOWER_LIMIT and T_QUALITY
+METRICS_PATH = None                 #e.g. "vector_metrics.jsonl" or "vector_metrics.csv" to save a row per frame, None to only print the summary
+SLOWEST_FRAMES = 10                 #How many of the slowest frames to list at the end of the run
+
+#What to write the output to. A .wav by default, or any other extension for a raw file of just the interleaved little endian samples
+#(e.g. "vector_osc_output.f32"), which also isn't limited to 4GB like a .wav is
+OUTPUT_FILE = "vector_osc_output.wav"
+SAMPLE_FORMAT = "s16"               #"s16", "s24" or "f32" (float32). 24 bit or float keeps finer positioning than 16 bit, worth it at large resolutions/sample rates
+
+#Instead of writing a .wav, stream each frame's raw samples (interleaved little endian 16 bit stereo at SAMPLE_RATE) live as it's
+#converted, e.g. "-" for stdout then pipe into something like: aplay -f S16_LE -c 2 -r SAMPLE_RATE. Frames that aren't ready in time
+#repeat the previous one, and underruns + latency are reported at the end so you can tell if your settings keep up in real time
+STREAM_OUTPUT = None                #None writes the .wav, "-" streams to stdout, anything else is a file/named pipe path to stream to
+STREAM_LOOKAHEAD = 8                #How many finished frames to buffer before starting the stream's clock. More rides out slow frames but adds latency
 
 ########USER VARIABLES END########
 
@@ -193,9 +231,8 @@ LOG_LEVEL = logging.ERROR           #How much output info do we want? CRITICAL >
 #Set some constants
 SAMPLE_POINTS = int(SAMPLE_RATE/FPS) #I.E. Sample rate / desired FPS
 CWD = os.getcwd()
-POTRACE_PATH = os.path.join(CWD, "potrace", "potrace.exe")
+POTRACE_PATH = find_potrace(os.path.join(CWD, "potrace"))
 bmp_folder = os.path.join(CWD, "input_bmps")
-svg_folder = os.path.join(CWD, "output_svgs")
 
 #Make logger and set both handler and logger to desired log level
 logger = logging.getLogger('Log')
@@ -212,56 +249,113 @@ logger.addHandler(logger_console)
 
 #Only run this section if it's the main script running, not a sub-process from multiprocessing
 if __name__ == '__main__':
+    #Opened first so when streaming to stdout everything printed from here on (here and in the workers) goes to stderr instead
+    stream_file = None if STREAM_OUTPUT is None else open_stream_target(STREAM_OUTPUT)
     print(f"MAIN: Sample rate / FPS give a point budget of {SAMPLE_POINTS} (Higher is better)")
     
-    #Get a list of all the .bmps
-    bmp_files = []
-
-    os.chdir(bmp_folder)
-    for file in glob.glob("*.bmp"):
-        bmp_files.append(file)
-        
-    #Sort them numerically
-    bmp_files.sort(key=lambda x: int(x.split('.')[0]))
-
-    #Split them into THREAD_COUNT # of chunks
-    bmp_chunks = np.array_split(bmp_files, THREAD_COUNT)
-
-    #Change CWD back for threads
-    os.chdir(CWD)
-    with Pool(THREAD_COUNT) as p:
-        results = (p.map(thread_wrapped_bmp_convert, bmp_chunks))
-        
-    #Combine each thread's sublist results once they're finished
-    complete_x_bytes = []
-    complete_y_bytes = []
-    for chunk_result in results:
-        complete_x_bytes+=chunk_result[0]
-        complete_y_bytes+=chunk_result[1]
-
-    print("MAIN: Finished point assignment, scaling + saving wav...")
-
-    #Scale, format and write the final audio files
-    x_16 = np.array(complete_x_bytes, dtype=np.int16)
-    y_16 = np.array(complete_y_bytes, dtype=np.int16)
-
-    ##Scale our amplitudes
-    x_16 = np.multiply(x_16, 65534/np.max(x_16))    #Slightly under 2^16 to account for lower signed + range and any rounding errors
-    y_16 = np.multiply(y_16, 65534/np.max(y_16))
-
-    #Center them around 0
-    x_max = np.max(x_16)
-    y_max = np.max(y_16)
-    x_16 = np.subtract(x_16, x_max/2)
-    y_16 = np.subtract(y_16, y_max/2)
-
-    stereo_amplitudes = np.array([x_16, y_16]).T.astype("<h")
-    os.chdir(CWD) #Set current dir to save
-
-    with wave.open("vector_osc_output.wav", "w") as f:
-        f.setnchannels(2)
-        f.setsampwidth(2)   #16 bit = 2 bytes
-        f.setframerate(SAMPLE_RATE)
-        f.writeframes(stereo_amplitudes.tobytes())
-
-    print("MAIN: Finished overall, file written")
+    if(VIDEO_PATH is None):
+        frames = folder_frames(bmp_folder, "bmp", THRESHOLD)
+    else:
+        frames = video_frames(VIDEO_PATH, FPS, Y_RESOLUTION, THRESHOLD)
+
+    #Traced SVG coordinates go up to the frame size (in 1/10ths of a pixel) so use that to scale every frame the same
+    first_frame = next(frames)
+    height, width = first_frame.shape
+    frames = itertools.chain([first_frame], frames)
+
+    """
+    Hand out small batches of consecutive frames as threads become free and write each one to the .wav in order as soon as
+    it's (and everything before it is) finished. Batches are sized from how long frames have been taking so each lasts about
+    CHUNK_SECONDS, which keeps every thread busy without one slow batch holding everything up. Batches always end on a multiple
+    of WARM_START_FRAMES so the density limits are carried through the same frames every run. Only a couple of batches per
+    thread are ever queued up so memory use doesn't grow with the length of the video
+    """
+    numbered_frames = enumerate(frames, 1)
+    pending = deque()
+    progress = {"seconds_per_frame": None}
+
+    #Runs on the main process as each batch finishes (in any order)
+    def record_progress(result):
+        chunk_points, seconds, chunk_metrics = result
+        chunk_length = len(chunk_points)//SAMPLE_POINTS
+        if(progress["seconds_per_frame"] is None):
+            progress["seconds_per_frame"] = seconds/chunk_length
+        else:
+            progress["seconds_per_frame"] = 0.8*progress["seconds_per_frame"] + 0.2*seconds/chunk_length
+
+    #Finished frames are cached by their content (plus any settings that change them) so repeats are only converted once.
+    #Note a cached frame may differ very slightly from a fresh conversion elsewhere as the density search would start from different limits.
+    #Frames still being converted are kept in in_flight as a one item list that's filled in with their samples once written, so
+    #repeats of them in any later batch can share it instead of being converted again
+    in_flight = {}
+    cache = FrameCache(CACHE_MEMORY_MB*2**20, CACHE_FOLDER, CACHE_DISK_MB*2**20)
+    CACHE_SETTINGS = ("vector", SAMPLE_POINTS, TRACER, A_QUALITY, T_QUALITY, OPT_TOLERANCE, CONTOUR_TOLERANCE, THRESHOLD_LIMIT, DENSITY_ABSOLUTE_LOWER_LIMIT, ORDER_PATHS, ORDER_PASSES)
+    static_reference = None
+    static_key = None   #Key of static_reference, which frames close enough to it share
+    frames_left = True
+
+    metrics_path = None if METRICS_PATH is None else os.path.join(CWD, METRICS_PATH)
+    if(stream_file is None):
+        output = SampleFile(os.path.join(CWD, OUTPUT_FILE), SAMPLE_RATE, width*SVG_UNITS_PER_PIXEL, height*SVG_UNITS_PER_PIXEL, SAMPLE_FORMAT)
+    else:
+        output = LiveStream(stream_file, FPS, width*SVG_UNITS_PER_PIXEL, height*SVG_UNITS_PER_PIXEL, STREAM_LOOKAHEAD)
+
+    with Pool(THREAD_COUNT) as p, output, MetricsLog(metrics_path, SLOWEST_FRAMES) as metrics_log:
+        while frames_left or len(pending) > 0:
+            if(progress["seconds_per_frame"] is None):
+                chunk_size = 1  #Start small (one group) until we know how long a frame takes
+            else:
+                chunk_size = int(np.clip(CHUNK_SECONDS/progress["seconds_per_frame"], 1, MAX_CHUNK_FRAMES))
+
+            #Plan out the next batch. Cached frames are filled in straight away, repeats of frames still being converted wait on
+            #them and only new frames are sent off to be converted. Frames close enough to the last new frame count as the same frame
+            frame_chunk = []
+            chunk_keys = []
+            plan = []   #For each frame in order either its finished samples or its in_flight slot
+            while frames_left and (len(plan) % WARM_START_FRAMES != 0 or (len(frame_chunk) < chunk_size and len(plan) < MAX_CHUNK_FRAMES)):
+                numbered_frame = next(numbered_frames, None)
+                if(numbered_frame is None):
+                    frames_left = False
+                    break
+
+                frame = numbered_frame[1]
+                if(not is_static(frame, static_reference, STATIC_FRAME_PIXELS)):
+                    static_reference = frame
+                    static_key = frame_key(frame, CACHE_SETTINGS)
+                key = static_key
+
+                cached_points = cache.get(key)
+                if(cached_points is not None):
+                    plan.append(cached_points)
+                elif(key in in_flight):
+                    plan.append(in_flight[key])
+                else:
+                    in_flight[key] = [None]
+                    plan.append(in_flight[key])
+                    frame_chunk.append(numbered_frame)
+                    chunk_keys.append(key)
+
+            if(len(plan) > 0):
+                result = None
+                if(len(frame_chunk) > 0):
+                    result = p.apply_async(thread_wrapped_bmp_convert, (frame_chunk,), callback=record_progress)
+                pending.append((result, chunk_keys, plan))
+
+            #Write out the oldest batch once the queue is full, or everything left once we're out of frames
+            if(len(pending) > 0 and (len(pending) >= THREAD_COUNT*2 or not frames_left)):
+                result, chunk_keys, plan = pending.popleft()
+                if(result is not None):
+                    chunk_points, _, chunk_metrics = result.get()
+                    chunk_points = chunk_points.reshape(-1, SAMPLE_POINTS, 2)
+                    for metrics in chunk_metrics:
+                        metrics_log.write(metrics)
+                    for key, frame_points in zip(chunk_keys, chunk_points):
+                        in_flight.pop(key)[0] = frame_points
+                        cache.put(key, frame_points.copy())
+
+                for entry in plan:
+                    output.write(entry[0] if isinstance(entry, list) else entry)
+                print(f"MAIN: Finished {len(plan)} frames ({len(plan) - len(chunk_keys)} reused), written to wav")
+
+    print(metrics_log.summary())
+    print(f"MAIN: Finished overall, {'file written' if stream_file is None else 'stream closed'}")